@@ -0,0 +1,114 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Reason codes returned with rejected transactions
+SAME_ID = "same-id"
+NO_RECEIVER = "no-receiver"
+NO_SENDER = "no-sender"
+INSUFFICIENT_FUNDS = "insufficient-funds"
+INVALID_AMOUNT = "invalid-amount"     # Zero or negative amount
+DUPLICATE = "duplicate"     # Already pending, given by Blockchain.addNewTransactions
+EVICTED = "evicted"         # Dropped to keep the mempool within its limits, also from addNewTransactions
+
+REASONS = [None, SAME_ID, NO_RECEIVER, NO_SENDER, INSUFFICIENT_FUNDS, INVALID_AMOUNT]
+
+
+def checkTransactions(nodesById, transactions):
+    # Decides which transactions of a batch can be made, in order, as if each
+    # accepted one had already moved its amount. Balances in nodesById are
+    # not changed. Returns (accepted, rejected) with rejected holding
+    # (transaction, reason) pairs.
+    if np is not None and len(transactions) > 1:
+        try:
+            return checkTransactionsVectorized(nodesById, transactions)
+        except OverflowError:
+            pass
+    return checkTransactionsSequential(nodesById, transactions)
+
+
+def staticReason(nodesById, transaction):
+    if transaction.senderId == transaction.receiverId:
+        return SAME_ID
+    if transaction.receiverId not in nodesById:
+        return NO_RECEIVER
+    if transaction.senderId not in nodesById:
+        return NO_SENDER
+    if transaction.amount <= 0:
+        return INVALID_AMOUNT
+    return None
+
+
+def checkTransactionsSequential(nodesById, transactions):
+    balances = {}
+    accepted = []
+    rejected = []
+
+    for transaction in transactions:
+        reason = staticReason(nodesById, transaction)
+        if reason is None:
+            senderId = transaction.senderId
+            receiverId = transaction.receiverId
+            senderBalance = balances.get(senderId, nodesById[senderId].balance)
+            if senderBalance < transaction.amount:
+                reason = INSUFFICIENT_FUNDS
+
+        if reason is not None:
+            rejected.append((transaction, reason))
+            continue
+
+        balances[senderId] = senderBalance - transaction.amount
+        balances[receiverId] = balances.get(receiverId, nodesById[receiverId].balance) + transaction.amount
+        accepted.append(transaction)
+
+    return accepted, rejected
+
+
+def checkTransactionsVectorized(nodesById, transactions):
+    count = len(transactions)
+    slots = {}
+    senders = np.empty(count, np.int64)
+    receivers = np.empty(count, np.int64)
+    sameId = np.zeros(count, bool)
+
+    # Map account IDs to slots of a local balance array, -1 for unknown IDs
+    for i, transaction in enumerate(transactions):
+        senderId = transaction.senderId
+        receiverId = transaction.receiverId
+        sameId[i] = senderId == receiverId
+        senders[i] = slots.setdefault(senderId, len(slots)) if senderId in nodesById else -1
+        receivers[i] = slots.setdefault(receiverId, len(slots)) if receiverId in nodesById else -1
+
+    amounts = np.fromiter((transaction.amount for transaction in transactions), np.int64, count)
+    balances = np.fromiter((nodesById[nodeId].balance for nodeId in slots), np.int64, len(slots))
+
+    codes = np.where(sameId, 1, np.where(receivers < 0, 2, np.where(senders < 0, 3, np.where(amounts <= 0, 5, 0))))
+    candidates = np.nonzero(codes == 0)[0]
+
+    if candidates.size:
+        # Total spent by each sender up to and including each transaction,
+        # ignoring what the sender receives within the batch. If no sender
+        # overdraws under that assumption, incoming amounts can only help and
+        # every candidate is accepted without a sequential pass.
+        candidateSenders = senders[candidates]
+        order = np.argsort(candidateSenders, kind = "stable")
+        sortedSenders = candidateSenders[order]
+        spent = np.cumsum(amounts[candidates][order])
+        groupStarts = np.ones(len(order), bool)
+        groupStarts[1:] = sortedSenders[1:] != sortedSenders[:-1]
+        startIndexes = np.maximum.accumulate(np.where(groupStarts, np.arange(len(order)), 0))
+        spent = spent - np.concatenate(([0], spent))[startIndexes]
+
+        if (spent <= balances[sortedSenders]).all():
+            accepted = [transactions[i] for i in candidates]
+            rejected = [(transactions[i], REASONS[codes[i]]) for i in np.nonzero(codes)[0]]
+            return accepted, rejected
+
+    else:
+        rejected = [(transactions[i], REASONS[codes[i]]) for i in range(count)]
+        return [], rejected
+
+    # Some sender may depend on funds received within the batch, replay the
+    # batch in order
+    return checkTransactionsSequential(nodesById, transactions)
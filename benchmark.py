@@ -0,0 +1,267 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from peer import MINING_WORKERS, Block, Blockchain, Transaction
+from peerClient import PeerConnection
+from peerServer import PeerServer
+from rsaKeys import loadAuthKey
+
+# Times the hot paths on synthetic data built from a fixed seed and writes
+# the results as JSON, so runs before and after a change can be compared:
+#   proofOfWork          calculateProofOfWork hashes per second
+#   serialization        saveBlockchain (toString) and loading a text chain
+#   transactionValidity  checkTransactionValidity against large node sets
+#   handshake            authenticated sessions and requests over loopback,
+#                        the PeerConnection / PeerServer pair initComm and
+#                        listen use; needs authKey.txt
+# Timings are the best of REPEATS runs.
+#
+#   python benchmark.py [results.json] [--sizes=1000,10000,100000]
+#   python benchmark.py compare before.json after.json
+
+SEED = 1
+REPEATS = 3
+POW_DIFFICULTY = 16         # Leading zero bits, about 65k hashes per block
+POW_BLOCKS = 8
+CHAIN_SIZES = (1000, 10000, 100000)
+TRANSACTIONS_PER_BLOCK = 10
+CHAIN_NODES = 100
+VALIDITY_NODE_COUNTS = (1000, 100000, 1000000)
+VALIDITY_CHECKS = 100000
+HANDSHAKES = 50
+REQUESTS = 2000
+REGRESSION_THRESHOLD = 0.10     # Relative slowdown compare reports
+
+
+def bestTime(function, repeats = REPEATS):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def quietly(function, *args):
+    # The chain and the peer server print as they work
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args)
+
+
+def benchmarkProofOfWork(workers):
+    blockchain = Blockchain(miningWorkers = workers)
+    rng = random.Random(SEED)
+    hashes = 0
+    start = time.perf_counter()
+    for index in range(1, POW_BLOCKS + 1):
+        block = Block(index, 0, "%064x" % rng.getrandbits(256), [], 1.0, POW_DIFFICULTY)
+        hashes += blockchain.calculateProofOfWork(block, rng.randrange(1 << 32)) + 1
+    elapsed = time.perf_counter() - start
+    # The parallel miner may try nonces past the one it returns, so its
+    # rate is a lower bound
+    return {"workers": workers, "blocks": POW_BLOCKS, "hashes": hashes, "hashesPerSecond": hashes / elapsed}
+
+
+def syntheticChain(blockCount):
+    rng = random.Random(SEED)
+    blockchain = Blockchain(miningWorkers = 1)
+    for nodeId in range(1, CHAIN_NODES + 1):
+        blockchain.addNode(nodeId, "10.0.%d.%d:5000" % (nodeId // 256, nodeId % 256), 10 ** 9)
+    prevBlock = blockchain.chain[-1]
+    for index in range(1, blockCount):
+        transactions = []
+        for _ in range(TRANSACTIONS_PER_BLOCK):
+            senderId, receiverId = rng.sample(range(1, CHAIN_NODES + 1), 2)
+            transactions.append(Transaction(senderId, receiverId, rng.randint(1, 100)))
+        transactions.append(Transaction("0", rng.randint(1, CHAIN_NODES), 1))
+        block = Block(index, rng.randrange(1 << 20), prevBlock.calculateHash(), transactions, prevBlock.timestamp + 60, POW_DIFFICULTY)
+        blockchain.appendBlock(block)
+        prevBlock = block
+    return blockchain
+
+
+def benchmarkSerialization(blockCount, filename):
+    blockchain = syntheticChain(blockCount)
+    toStringSeconds = bestTime(blockchain.toString)
+    saveSeconds = bestTime(lambda: blockchain.saveBlockchain(filename))
+    loadSeconds = bestTime(lambda: Blockchain(filename, miningWorkers = 1))
+    result = {
+        "blocks": blockCount,
+        "bytes": os.path.getsize(filename),
+        "toStringSeconds": toStringSeconds,
+        "saveSeconds": saveSeconds,
+        "loadSeconds": loadSeconds,
+        "loadBlocksPerSecond": blockCount / loadSeconds,
+    }
+    os.remove(filename)
+    return result
+
+
+def benchmarkTransactionValidity(nodeCount):
+    rng = random.Random(SEED)
+    blockchain = Blockchain(miningWorkers = 1)
+    for nodeId in range(1, nodeCount + 1):
+        blockchain.addNode(nodeId, str(nodeId), 10 ** 9)
+    transactions = []
+    for _ in range(VALIDITY_CHECKS):
+        senderId, receiverId = rng.sample(range(1, nodeCount + 1), 2)
+        transactions.append(Transaction(senderId, receiverId, rng.randint(1, 100)))
+
+    def checkAll():
+        for transaction in transactions:
+            blockchain.checkTransactionValidity(transaction)
+
+    seconds = bestTime(checkAll)
+    return {"nodes": nodeCount, "checks": VALIDITY_CHECKS, "checksPerSecond": VALIDITY_CHECKS / seconds}
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def cancelTasks():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+
+
+def benchmarkHandshake(key):
+    # Runs a PeerServer that accepts every request on its own event loop
+    port = freePort()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target = loop.run_forever, daemon = True)
+    thread.start()
+    server = PeerServer(lambda typeOfReq, otherPeerId, amount, nonce: True, 2, key)
+    asyncio.run_coroutine_threadsafe(server.serve("127.0.0.1", port), loop)
+    try:
+        for _ in range(100):
+            try:
+                PeerConnection("127.0.0.1", port, 1, key).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+        handshakes = []
+        for _ in range(HANDSHAKES):
+            start = time.perf_counter()
+            connection = PeerConnection("127.0.0.1", port, 1, key)
+            handshakes.append(time.perf_counter() - start)
+            connection.close()
+
+        connection = PeerConnection("127.0.0.1", port, 1, key)
+        start = time.perf_counter()
+        futures = [connection.submit(True, 10, nonce) for nonce in range(1, REQUESTS + 1)]
+        for future in futures:
+            future.result()
+        requestSeconds = time.perf_counter() - start
+        connection.close()
+    finally:
+        asyncio.run_coroutine_threadsafe(cancelTasks(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return {
+        "handshakes": HANDSHAKES,
+        "handshakeMeanSeconds": statistics.mean(handshakes),
+        "handshakeP95Seconds": statistics.quantiles(handshakes, n = 20)[-1],
+        "requests": REQUESTS,
+        "requestsPerSecond": REQUESTS / requestSeconds,
+    }
+
+
+def runBenchmarks(chainSizes = CHAIN_SIZES):
+    results = {"proofOfWork": {}, "serialization": {}, "transactionValidity": {}}
+    for workers in sorted({1, MINING_WORKERS}):
+        results["proofOfWork"][str(workers)] = quietly(benchmarkProofOfWork, workers)
+    for blockCount in chainSizes:
+        filename = "benchmark-chain-%d.txt" % blockCount
+        results["serialization"][str(blockCount)] = quietly(benchmarkSerialization, blockCount, filename)
+    for nodeCount in VALIDITY_NODE_COUNTS:
+        results["transactionValidity"][str(nodeCount)] = quietly(benchmarkTransactionValidity, nodeCount)
+    try:
+        key = loadAuthKey()
+    except OSError:
+        results["handshake"] = {"skipped": "no authKey.txt, run keyGen.py"}
+    else:
+        results["handshake"] = quietly(benchmarkHandshake, key)
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": SEED,
+            "repeats": REPEATS,
+        },
+        "results": results,
+    }
+
+
+def flatten(results, prefix = ""):
+    metrics = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, prefix + name + "."))
+        elif isinstance(value, float):
+            metrics[prefix + name] = value
+    return metrics
+
+
+def compareRuns(before, after, threshold = REGRESSION_THRESHOLD):
+    # Returns (metric, before, after, relative slowdown) for every metric
+    # that got worse by more than threshold. Rates are better higher, times
+    # better lower.
+    beforeMetrics = flatten(before["results"])
+    afterMetrics = flatten(after["results"])
+    regressions = []
+    for metric, old in beforeMetrics.items():
+        new = afterMetrics.get(metric)
+        if new is None or old <= 0 or new <= 0:
+            continue
+        slowdown = old / new - 1 if metric.endswith("PerSecond") else new / old - 1
+        if slowdown > threshold:
+            regressions.append((metric, old, new, slowdown))
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        with open(sys.argv[2], 'r') as beforeFile, open(sys.argv[3], 'r') as afterFile:
+            regressions = compareRuns(json.load(beforeFile), json.load(afterFile))
+        for metric, old, new, slowdown in regressions:
+            print(f"{metric}: {old:.6g} -> {new:.6g} ({slowdown:+.0%} slower)")
+        if regressions:
+            sys.exit(1)
+        print("No regressions over", format(REGRESSION_THRESHOLD, ".0%"))
+        sys.exit(0)
+
+    chainSizes = CHAIN_SIZES
+    outputFilename = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--sizes="):
+            chainSizes = [int(size) for size in arg[len("--sizes="):].split(",")]
+        else:
+            outputFilename = arg
+
+    report = json.dumps(runBenchmarks(chainSizes), indent = 2)
+    if outputFilename is None:
+        print(report)
+    else:
+        with open(outputFilename, 'w') as opFile:
+            opFile.write(report)
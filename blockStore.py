@@ -0,0 +1,313 @@
+import collections
+import os
+import struct
+import zlib
+
+import chainFormat
+from batchAdmission import checkTransactions
+from lazyChain import LazyChain, mapFile
+from mempool import transactionId
+
+# Append only block store kept in a directory:
+#   blocks.log              header, then one record per sealed block, only
+#                           appended to or cut back after a reorganization
+#   state.chk               block count, tip hash, mempool and nodes,
+#                           replaced atomically on each save
+#   balances-<height>.snap  block count, tip hash and nodes, written every
+#                           SNAPSHOT_INTERVAL blocks
+# A block log record is a length, a CRC32 of the payload and the payload
+# written by chainFormat.encodeBlock. A record cut short by a crash, or one
+# whose CRC doesn't match, marks the end of the log and is truncated away
+# when the store is opened.
+#
+# Checkpoints and snapshots hold the balances the chain alone gives at
+# their block count, without the mempool. Loading starts from the
+# checkpoint, or from the newest snapshot still on the chain if the
+# checkpoint doesn't match the log, and applies only the blocks after it.
+# The first snapshot of a store is taken at the genesis block, even for a
+# store created from a longer chain, and is never removed. verifyBalances.py
+# rebuilds the balances from it.
+
+LOG_MAGIC = b"LBPL"
+CHECKPOINT_MAGIC = b"LBPS"
+LOG_VERSION = 1
+CHECKPOINT_VERSION = 2
+SNAPSHOT_INTERVAL = 1000    # Blocks between balance snapshots
+SNAPSHOTS_KEPT = 4          # Newest snapshots kept besides the first
+
+RECORD_HEADER = struct.Struct("<II")    # payload length, CRC32
+
+NodeBalance = collections.namedtuple("NodeBalance", "id address balance")
+
+
+class BlockStoreError(Exception):
+    pass
+
+
+def blockChanges(blocks, balanceChanges):
+    # Net balance change per node id of blocks
+    changes = collections.Counter()
+    for block in blocks:
+        changes.update(balanceChanges(block.uncommittedTransactions))
+    return changes
+
+
+def writeState(filename, blockCount, tipHash, transactions, nodes):
+    data = b"".join((
+        chainFormat.HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION),
+        chainFormat.COUNT.pack(blockCount),
+        chainFormat.encodeHash(tipHash),
+        chainFormat.encodeTransactions(transactions),
+        chainFormat.encodeNodes(nodes),
+    ))
+    temporaryFilename = filename + ".tmp"
+    with open(temporaryFilename, 'wb') as stateFile:
+        stateFile.write(data)
+        stateFile.flush()
+        os.fsync(stateFile.fileno())
+    os.replace(temporaryFilename, filename)
+
+
+def readState(filename, Transaction, Node):
+    # Returns (block count, tip hash, transactions, nodes). The tip hash of
+    # a version 1 checkpoint is None and its balances include its mempool.
+    with open(filename, 'rb') as stateFile:
+        data = stateFile.read()
+    magic, version = chainFormat.HEADER.unpack_from(data, 0)
+    if magic != CHECKPOINT_MAGIC or version not in (1, CHECKPOINT_VERSION):
+        raise BlockStoreError("Not a checkpoint: " + filename)
+    offset = chainFormat.HEADER.size
+    (blockCount,) = chainFormat.COUNT.unpack_from(data, offset)
+    offset += chainFormat.COUNT.size
+    tipHash = None
+    if version == CHECKPOINT_VERSION:
+        tipHash, offset = chainFormat.decodeHash(data, offset)
+    transactions, offset = chainFormat.decodeTransactions(data, offset, Transaction)
+    nodes, offset = chainFormat.decodeNodes(data, offset, Node)
+    return blockCount, tipHash, transactions, nodes
+
+
+def syncDirectory(directory):
+    # Makes a rename inside directory durable, not supported on every platform
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class BlockStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.logFilename = os.path.join(directory, "blocks.log")
+        self.checkpointFilename = os.path.join(directory, "state.chk")
+        self.offsets = []   # Payload offset and length of every block record
+        os.makedirs(directory, exist_ok = True)
+        self.recover()
+
+    @property
+    def blockCount(self):
+        return len(self.offsets)
+
+    def recover(self):
+        # Indexes the log and cuts off a partially written tail
+        header = chainFormat.HEADER.pack(LOG_MAGIC, LOG_VERSION)
+        if not os.path.exists(self.logFilename) or os.path.getsize(self.logFilename) < len(header):
+            with open(self.logFilename, 'wb') as logFile:
+                logFile.write(header)
+                logFile.flush()
+                os.fsync(logFile.fileno())
+            syncDirectory(self.directory)
+            self.offsets = []
+            return
+
+        data = mapFile(self.logFilename)
+        try:
+            magic, version = chainFormat.HEADER.unpack_from(data, 0)
+            if magic != LOG_MAGIC or version != LOG_VERSION:
+                raise BlockStoreError("Not a block log: " + self.logFilename)
+
+            self.offsets = []
+            offset = len(header)
+            view = memoryview(data)
+            while offset + RECORD_HEADER.size <= len(data):
+                length, crc = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                if length == 0 or start + length > len(data) or zlib.crc32(view[start:start + length]) != crc:
+                    break
+                self.offsets.append((start, length))
+                offset = start + length
+            view.release()
+            size = len(data)
+        finally:
+            data.close()
+
+        if offset != size:
+            with open(self.logFilename, 'r+b') as logFile:
+                logFile.truncate(offset)
+                logFile.flush()
+                os.fsync(logFile.fileno())
+
+    def appendBlocks(self, blocks):
+        if not blocks:
+            return
+        with open(self.logFilename, 'ab') as logFile:
+            offset = logFile.tell()
+            for block in blocks:
+                payload = chainFormat.encodeBlock(block)
+                logFile.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+                logFile.write(payload)
+                offset += RECORD_HEADER.size
+                self.offsets.append((offset, len(payload)))
+                offset += len(payload)
+            logFile.flush()
+            os.fsync(logFile.fileno())
+
+    def writeCheckpoint(self, blockchain):
+        confirmed = blockchain.confirmedNodes()
+        nodes = [confirmed[node.id] for node in blockchain.nodes]
+        writeState(self.checkpointFilename, self.blockCount, blockchain.chain[-1].calculateHash(), blockchain.uncommittedTransactions, nodes)
+        syncDirectory(self.directory)
+
+    def snapshotFilename(self, height):
+        return os.path.join(self.directory, "balances-" + str(height) + ".snap")
+
+    def snapshotHeights(self):
+        heights = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith("balances-") and filename.endswith(".snap"):
+                heights.append(int(filename[len("balances-"):-len(".snap")]))
+        return sorted(heights)
+
+    def readSnapshot(self, height, Transaction, Node):
+        return readState(self.snapshotFilename(height), Transaction, Node)
+
+    def writeSnapshot(self, blockchain):
+        # Takes the snapshot at the genesis block if the store has none yet
+        # (stores written before it was kept start from a later one) and one
+        # at the last multiple of SNAPSHOT_INTERVAL reached, then removes the
+        # oldest but the first beyond SNAPSHOTS_KEPT
+        heights = self.snapshotHeights()
+        chain = blockchain.chain
+        newHeights = [] if heights and heights[0] == 1 else [1]
+        height = len(chain) - len(chain) % SNAPSHOT_INTERVAL
+        if height > max(heights + newHeights):
+            newHeights.append(height)
+        if not newHeights:
+            return
+
+        # Balances at height are those of the tip without the blocks after it
+        confirmed = blockchain.confirmedNodes()
+        for height in newHeights:
+            changes = blockChanges((chain[i] for i in range(height, len(chain))), blockchain.balanceChanges)
+            nodes = []
+            for node in blockchain.nodes:
+                nodes.append(NodeBalance(node.id, node.address, confirmed[node.id].balance - changes[node.id]))
+            writeState(self.snapshotFilename(height), height, chain[height - 1].calculateHash(), [], nodes)
+
+        heights = sorted(heights + newHeights)
+        for oldHeight in heights[1:-SNAPSHOTS_KEPT]:
+            os.remove(self.snapshotFilename(oldHeight))
+        syncDirectory(self.directory)
+
+    def storedHash(self, index):
+        start, length = self.offsets[index]
+        with open(self.logFilename, 'rb') as logFile:
+            logFile.seek(start)
+            payload = logFile.read(length)
+        blockHash, _ = chainFormat.decodeHash(payload, chainFormat.BLOCK_FIELDS.size)
+        return blockHash
+
+    def rewind(self, blockchain):
+        # Cuts off logged blocks that a reorganization took off the chain
+        count = min(self.blockCount, len(blockchain.chain))
+        while count > 0 and self.storedHash(count - 1) != blockchain.chain[count - 1].calculateHash():
+            count -= 1
+        if count == self.blockCount:
+            return
+        # Snapshots past the fork point are of the old chain
+        for height in self.snapshotHeights():
+            if height > count:
+                os.remove(self.snapshotFilename(height))
+        end = self.offsets[count][0] - RECORD_HEADER.size
+        with open(self.logFilename, 'r+b') as logFile:
+            logFile.truncate(end)
+            logFile.flush()
+            os.fsync(logFile.fileno())
+        del self.offsets[count:]
+
+    def save(self, blockchain):
+        # Only blocks sealed since the last save are written
+        self.rewind(blockchain)
+        self.appendBlocks(blockchain.chain[self.blockCount:])
+        self.writeSnapshot(blockchain)
+        self.writeCheckpoint(blockchain)
+
+    def load(self, blockchain, Block, Transaction, Node, lazy = False):
+        # With lazy the log is memory-mapped and blocks are decoded on access
+        if lazy:
+            blockchain.chain = LazyChain(mapFile(self.logFilename), list(self.offsets), Block, Transaction)
+        else:
+            with open(self.logFilename, 'rb') as logFile:
+                data = logFile.read()
+            for start, _ in self.offsets:
+                block, _ = chainFormat.decodeBlock(data, start, Block, Transaction)
+                blockchain.appendBlock(block)
+
+        if not os.path.exists(self.checkpointFilename):
+            return
+        blockCount, tipHash, transactions, nodes = readState(self.checkpointFilename, Transaction, Node)
+        if tipHash is None and 0 < blockCount <= self.blockCount:
+            tipHash = self.storedHash(blockCount - 1)
+            changes = blockchain.balanceChanges(transactions)
+            for node in nodes:
+                node.balance -= changes.get(node.id, 0)
+
+        if not self.isOnLog(blockCount, tipHash):
+            snapshot = self.latestSnapshot(Transaction, Node)
+            if snapshot is None:
+                raise BlockStoreError("Checkpoint doesn't match the block log")
+            print("Checkpoint doesn't match the block log, loading the snapshot of block", snapshot[0] - 1)
+            # Nodes registered after the snapshot keep their checkpoint balance
+            snapshotIds = {node.id for node in snapshot[3]}
+            nodes = snapshot[3] + [node for node in nodes if node.id not in snapshotIds]
+            blockCount = snapshot[0]
+
+        for node in nodes:
+            blockchain.registerNode(node)
+        chain = blockchain.chain
+        newBlocks = [chain[i] for i in range(blockCount, len(chain))]
+        blockchain.applyBalanceChanges(blockChanges(newBlocks, blockchain.balanceChanges), 1)
+
+        # Transactions of the blocks after the checkpoint are no longer
+        # pending, the rest are checked again against the new balances
+        committed = collections.Counter(
+            transactionId(transaction) for block in newBlocks for transaction in block.uncommittedTransactions
+        )
+        pending = []
+        for transaction in transactions:
+            txId = transactionId(transaction)
+            if committed[txId] > 0:
+                committed[txId] -= 1
+            else:
+                pending.append(transaction)
+        accepted, _ = checkTransactions(blockchain.nodesById, pending)
+        blockchain.applyBalanceChanges(blockchain.balanceChanges(accepted), 1)
+        blockchain.loadMempool(accepted)
+
+    def isOnLog(self, blockCount, tipHash):
+        return 0 < blockCount <= self.blockCount and self.storedHash(blockCount - 1) == tipHash
+
+    def latestSnapshot(self, Transaction, Node):
+        # The newest snapshot of a block still in the log, or None
+        for height in reversed(self.snapshotHeights()):
+            snapshot = self.readSnapshot(height, Transaction, Node)
+            if self.isOnLog(snapshot[0], snapshot[1]):
+                return snapshot
+        return None
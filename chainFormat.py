@@ -0,0 +1,286 @@
+import itertools
+import struct
+
+# Binary chain file:
+#   header      magic, format version
+#   blocks      block count, then per block a length prefixed record
+#   mempool     transactions
+#   nodes       node count, then per node id, balance and a length prefixed address
+# A block record holds the fixed width block fields, the block's own hash,
+# the previous hash, the Merkle root if the block has one (together the
+# block header) and the transactions. MERKLE_FLAG is set in the kind byte of
+# the block's own hash when a raw 32 byte Merkle root follows the previous
+# hash.
+# Transactions are stored as a width, a count and fixed width (senderId,
+# receiverId, amount) triples, using the narrowest width that fits every
+# transaction of the record. If any transaction has a nonce the width has
+# NONCE_FLAG set and every transaction gets a fourth field, 0 for none.
+# All integers are little endian.
+
+MAGIC = b"LBPC"
+VERSION = 1
+
+HEADER = struct.Struct("<4sH")
+COUNT = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+SHORT_LENGTH = struct.Struct("<H")
+BLOCK_FIELDS = struct.Struct("<QdQB")     # index, timestamp, proofOfWorkNo, difficulty (0 = not stored)
+TRANSACTIONS_HEADER = struct.Struct("<BI")    # width, count
+NODE_FIELDS = struct.Struct("<qq")        # id, balance
+NONCE_FLAG = 0x80
+
+TRANSACTION_FORMATS = {
+    2: struct.Struct("<HHH"),
+    4: struct.Struct("<III"),
+    8: struct.Struct("<qqq"),
+    NONCE_FLAG | 2: struct.Struct("<HHHH"),
+    NONCE_FLAG | 4: struct.Struct("<IIII"),
+    NONCE_FLAG | 8: struct.Struct("<qqqq"),
+}
+
+# What struct and the slicing below raise on truncated or malformed data,
+# the decoders turn them into ChainFormatError
+DECODE_ERRORS = (struct.error, IndexError, ValueError, UnicodeDecodeError)
+
+RAW_HASH = 0        # 32 byte sha256 digest of a hex hash
+TEXT_HASH = 1       # any other hash string, e.g. the genesis block's "0"
+MERKLE_FLAG = 0x80
+
+
+class ChainFormatError(Exception):
+    pass
+
+
+def isBinaryChain(filename):
+    with open(filename, 'rb') as ipFile:
+        return ipFile.read(len(MAGIC)) == MAGIC
+
+
+def transactionWidth(values):
+    smallest = min(values, default = 0)
+    largest = max(values, default = 0)
+    if smallest >= 0 and largest < 1 << 16:
+        return 2
+    if smallest >= 0 and largest < 1 << 32:
+        return 4
+    return 8
+
+
+def encodeTransactions(transactions):
+    withNonces = any(transaction.nonce is not None for transaction in transactions)
+    values = []
+    for transaction in transactions:
+        values.append(int(transaction.senderId))
+        values.append(int(transaction.receiverId))
+        values.append(int(transaction.amount))
+        if withNonces:
+            values.append(transaction.nonce or 0)
+    width = transactionWidth(values)
+    code = TRANSACTION_FORMATS[width].format[-1]
+    if withNonces:
+        width |= NONCE_FLAG
+    return TRANSACTIONS_HEADER.pack(width, len(transactions)) + struct.pack("<" + str(len(values)) + code, *values)
+
+
+def decodeTransactions(data, offset, Transaction):
+    width, count = TRANSACTIONS_HEADER.unpack_from(data, offset)
+    offset += TRANSACTIONS_HEADER.size
+    unpacker = TRANSACTION_FORMATS.get(width)
+    if unpacker is None:
+        raise ChainFormatError("Unknown transaction width " + str(width))
+    end = offset + count * unpacker.size
+    # Fields are in Transaction(senderId, receiverId, amount, nonce) order
+    fields = unpacker.iter_unpack(data[offset:end])
+    if width & NONCE_FLAG:
+        transactions = [Transaction(senderId, receiverId, amount, nonce or None) for senderId, receiverId, amount, nonce in fields]
+    else:
+        transactions = list(itertools.starmap(Transaction, fields))
+    return transactions, end
+
+
+def encodeHash(blockHash):
+    blockHash = str(blockHash)
+    if len(blockHash) == 64:
+        try:
+            raw = bytes.fromhex(blockHash)
+            if raw.hex() == blockHash:
+                return bytes((RAW_HASH,)) + raw
+        except ValueError:
+            pass
+    text = blockHash.encode()
+    return bytes((TEXT_HASH,)) + SHORT_LENGTH.pack(len(text)) + text
+
+
+def decodeHash(data, offset):
+    kind = data[offset] & ~MERKLE_FLAG
+    offset += 1
+    if kind == RAW_HASH:
+        return bytes(data[offset:offset + 32]).hex(), offset + 32
+    (length,) = SHORT_LENGTH.unpack_from(data, offset)
+    offset += SHORT_LENGTH.size
+    return bytes(data[offset:offset + length]).decode(), offset + length
+
+
+def encodeHeader(block):
+    # The start of a block record, everything but the transactions
+    difficulty = block.difficulty or 0
+    blockHash = encodeHash(block.calculateHash())
+    merkleRoot = b""
+    if block.merkleRoot is not None:
+        blockHash = bytes((blockHash[0] | MERKLE_FLAG,)) + blockHash[1:]
+        merkleRoot = bytes.fromhex(block.merkleRoot)
+    return b"".join((
+        BLOCK_FIELDS.pack(block.index, block.timestamp, block.proofOfWorkNo, difficulty),
+        blockHash,
+        encodeHash(block.prevHash),
+        merkleRoot,
+    ))
+
+
+def decodeHeader(data, offset, Block):
+    # Returns a Block without transactions whose cached hash is the stored one
+    try:
+        return readHeader(data, offset, Block)
+    except DECODE_ERRORS as error:
+        raise ChainFormatError("Malformed block header: " + str(error)) from error
+
+
+def readHeader(data, offset, Block):
+    index, timestamp, proofOfWorkNo, difficulty = BLOCK_FIELDS.unpack_from(data, offset)
+    offset += BLOCK_FIELDS.size
+    hasMerkleRoot = data[offset] & MERKLE_FLAG
+    blockHash, offset = decodeHash(data, offset)
+    prevHash, offset = decodeHash(data, offset)
+    merkleRoot = None
+    if hasMerkleRoot:
+        merkleRoot = bytes(data[offset:offset + 32]).hex()
+        offset += 32
+
+    block = Block(
+        index = index,
+        proofOfWorkNo = proofOfWorkNo,
+        prevHash = prevHash,
+        uncommittedTransactions = [],
+        timestamp = timestamp,
+        difficulty = difficulty or None,
+        merkleRoot = merkleRoot
+    )
+    block.blockHash = blockHash
+    return block, offset
+
+
+def encodeBlock(block):
+    return encodeHeader(block) + encodeTransactions(block.uncommittedTransactions)
+
+
+def decodeBlock(data, offset, Block, Transaction):
+    # The stored hash is taken as the block's cached hash, see checkHash
+    block, offset = decodeHeader(data, offset, Block)
+    try:
+        block.uncommittedTransactions, offset = decodeTransactions(data, offset, Transaction)
+    except DECODE_ERRORS as error:
+        raise ChainFormatError("Malformed block transactions: " + str(error)) from error
+    return block, offset
+
+
+def checkHash(block):
+    # Recomputes the hash of a decoded block, which must match the stored one
+    storedHash = block.blockHash
+    block.blockHash = None
+    if block.calculateHash() != storedHash:
+        raise ChainFormatError("Stored hash of block " + str(block.index) + " doesn't match the block")
+
+
+def encodeNodes(nodes):
+    parts = [LENGTH.pack(len(nodes))]
+    for node in nodes:
+        address = str(node.address).encode()
+        parts.append(NODE_FIELDS.pack(int(node.id), int(node.balance)))
+        parts.append(SHORT_LENGTH.pack(len(address)))
+        parts.append(address)
+    return b"".join(parts)
+
+
+def decodeNodes(data, offset, Node):
+    (count,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    nodes = []
+    for _ in range(count):
+        nodeId, balance = NODE_FIELDS.unpack_from(data, offset)
+        offset += NODE_FIELDS.size
+        (addressLength,) = SHORT_LENGTH.unpack_from(data, offset)
+        offset += SHORT_LENGTH.size
+        address = bytes(data[offset:offset + addressLength]).decode()
+        offset += addressLength
+        nodes.append(Node(nodeId = nodeId, address = address, balance = balance))
+    return nodes, offset
+
+
+def encodeBlocks(blocks):
+    parts = []
+    for block in blocks:
+        record = encodeBlock(block)
+        parts.append(LENGTH.pack(len(record)))
+        parts.append(record)
+    return b"".join(parts)
+
+
+def encodeChain(blockchain, encoded = None):
+    # encoded is the (block count, tip hash, block records) an earlier
+    # encodeChain or decodeChain returned. Blocks are sealed for good, so if
+    # its tip is still on the chain its records are reused and only the
+    # blocks after it are encoded. Returns the data and the new encoded.
+    chain = blockchain.chain
+    blockCount, blocks = 0, b""
+    if encoded is not None:
+        encodedCount, tipHash, records = encoded
+        if 0 < encodedCount <= len(chain) and chain[encodedCount - 1].calculateHash() == tipHash:
+            blockCount, blocks = encodedCount, records
+    blocks += encodeBlocks(chain[i] for i in range(blockCount, len(chain)))
+    data = b"".join((
+        HEADER.pack(MAGIC, VERSION),
+        COUNT.pack(len(chain)),
+        blocks,
+        encodeTransactions(blockchain.uncommittedTransactions),
+        encodeNodes(blockchain.nodes),
+    ))
+    return data, (len(chain), chain[-1].calculateHash(), blocks)
+
+
+def checkHeader(data):
+    if len(data) < HEADER.size:
+        raise ChainFormatError("File too short for a chain header")
+    magic, version = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ChainFormatError("Not a binary chain file")
+    if version != VERSION:
+        raise ChainFormatError("Unsupported chain format version " + str(version))
+    return HEADER.size
+
+
+def decodeChain(data, blockchain, Block, Transaction, Node, trusted = False):
+    # Fills an empty Blockchain from the bytes written by encodeChain. Every
+    # block's hash is recomputed, as loading the text format does, unless
+    # the data is trusted, e.g. a file this node wrote itself. Returns the
+    # block records in the form encodeChain takes them.
+    offset = checkHeader(data)
+    (blockCount,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    blocksStart = offset
+
+    for _ in range(blockCount):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        block, _ = decodeBlock(data, offset, Block, Transaction)
+        if not trusted:
+            checkHash(block)
+        blockchain.appendBlock(block)
+        offset += length
+    encoded = (blockCount, blockchain.chain[-1].calculateHash(), bytes(data[blocksStart:offset])) if blockCount else None
+
+    transactions, offset = decodeTransactions(data, offset, Transaction)
+    nodes, offset = decodeNodes(data, offset, Node)
+    for node in nodes:
+        blockchain.registerNode(node)
+    blockchain.loadMempool(transactions)
+    return encoded
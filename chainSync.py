@@ -0,0 +1,197 @@
+import asyncio
+
+import chainFormat
+from gossip import MAX_HEADERS, authenticate, encodeHashes
+from wireProtocol import BLOCK, END, GETDATA, GETHEADERS, HEADERS, ProtocolError, encodeFields, readFrame, writeFrame
+
+BODIES_PER_REQUEST = 128    # Block hashes asked for in one GETDATA
+SYNC_TIMEOUT = 30           # Seconds to wait on a sync peer before giving up on it
+SYNC_ERRORS = (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ProtocolError, chainFormat.ChainFormatError)
+
+
+class SyncLink:
+    # An authenticated session with a peer server used only for syncing
+
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, msgType, payload):
+        await writeFrame(self.writer, msgType, payload, SYNC_TIMEOUT)
+
+    async def expect(self, msgType):
+        # The server may announce new blocks on this session, skip them
+        while True:
+            receivedType, payload = await readFrame(self.reader, SYNC_TIMEOUT)
+            if receivedType == msgType:
+                return payload
+            if receivedType == END:
+                raise ConnectionError("Peer ended the session")
+
+    def close(self):
+        self.writer.close()
+
+
+class ChainSync:
+    # Catches a stale chain up with its peers headers first. The headers
+    # after our tip are downloaded and checked like validateNewBlock does
+    # (index, hash links, difficulty, timestamps and, for headers with a
+    # Merkle root, the proof of work), then the block bodies are fetched
+    # from every peer at once in batches and applied in order with
+    # blockchain.receiveBlock. A legacy header's proof can't be checked on
+    # its own since it covers the transactions, but every body has to hash
+    # to its header's hash and match its Merkle root, so a peer can't swap
+    # a body without breaking the header chain.
+
+    def __init__(self, blockchain, Block, Transaction, key):
+        self.blockchain = blockchain
+        self.Block = Block
+        self.Transaction = Transaction
+        self.key = key
+        self.bodies = {}
+        self.arrived = asyncio.Event()
+        self.workers = []
+
+    async def open(self, host, port):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), SYNC_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            print("Couldn't reach", (host, port), "to sync")
+            return None
+        try:
+            await authenticate(reader, writer, self.key)
+        except Exception:
+            writer.close()
+            print("Couldn't authenticate with", (host, port))
+            return None
+        return SyncLink((host, port), reader, writer)
+
+    async def run(self, addresses):
+        # Returns the number of blocks added to the chain
+        links = [link for link in await asyncio.gather(*(self.open(host, port) for host, port in addresses)) if link]
+        if not links:
+            return 0
+        try:
+            headers = []
+            for link in links:
+                try:
+                    peerHeaders = await self.downloadHeaders(link)
+                except SYNC_ERRORS:
+                    continue
+                if len(peerHeaders) > len(headers):
+                    headers = peerHeaders
+            if not headers:
+                return 0
+            print("Syncing", len(headers), "blocks from", len(links), "peers")
+            return await self.downloadBodies(links, headers)
+        finally:
+            for link in links:
+                link.close()
+
+    async def downloadHeaders(self, link):
+        # Returns the peer's valid headers following our tip
+        chain = self.blockchain.chain
+        chainLength = len(chain)
+        headers = []
+
+        def getBlock(index):
+            if index < chainLength:
+                return chain[index]
+            return headers[index - chainLength]
+
+        prevBlock = chain[-1]
+        while True:
+            await link.send(GETHEADERS, encodeFields(prevBlock.index + 1, MAX_HEADERS))
+            payload = await link.expect(HEADERS)
+            offset = 0
+            count = 0
+            while offset < len(payload):
+                header, offset = chainFormat.decodeHeader(payload, offset, self.Block)
+                # A header with a Merkle root has its hash recomputed, only a
+                # legacy header's has to be taken as sent
+                if header.merkleRoot is not None:
+                    header.blockHash = None
+                count += 1
+                if not self.blockchain.validateNewBlock(header, prevBlock, headerOnly = True, getBlock = getBlock):
+                    print("Invalid header", header.index, "from", link.address)
+                    return headers
+                headers.append(header)
+                prevBlock = header
+            if count < MAX_HEADERS:
+                return headers
+
+    async def downloadBodies(self, links, headers):
+        queue = asyncio.Queue()
+        for i in range(0, len(headers), BODIES_PER_REQUEST):
+            queue.put_nowait(headers[i:i + BODIES_PER_REQUEST])
+
+        self.bodies.clear()
+        self.workers = [asyncio.create_task(self.fetchBodies(link, queue)) for link in links]
+        try:
+            return await self.applyBodies(headers)
+        finally:
+            for worker in self.workers:
+                worker.cancel()
+
+    async def fetchBodies(self, link, queue):
+        # Keeps one batch in flight on the link, a batch the peer fails to
+        # deliver goes back to the queue for the other peers
+        try:
+            while True:
+                batch = await queue.get()
+                wanted = {header.calculateHash(): header for header in batch}
+                try:
+                    await link.send(GETDATA, encodeHashes(wanted))
+                    while wanted:
+                        payload = await link.expect(BLOCK)
+                        block, _ = chainFormat.decodeBlock(payload, 0, self.Block, self.Transaction)
+                        # Never trust the hash sent along with the block
+                        block.blockHash = None
+                        blockHash = block.calculateHash()
+                        if block.merkleRoot is not None and block.merkleRoot != block.calculateMerkleRoot():
+                            raise ProtocolError("Block body doesn't match its Merkle root")
+                        if wanted.pop(blockHash, None) is not None:
+                            self.bodies[blockHash] = block
+                            self.arrived.set()
+                except SYNC_ERRORS:
+                    queue.put_nowait(list(wanted.values()))
+                    print("Sync peer", link.address, "dropped")
+                    return
+        finally:
+            self.arrived.set()
+
+    def applyBlocks(self, blocks):
+        applied = 0
+        for block in blocks:
+            if not self.blockchain.receiveBlock(block):
+                print("Block", block.index, "failed validation")
+                break
+            applied += 1
+        return applied
+
+    async def applyBodies(self, headers):
+        loop = asyncio.get_running_loop()
+        applied = 0
+        while applied < len(headers):
+            # Apply every body that's next in line in one go
+            ready = []
+            while applied + len(ready) < len(headers):
+                block = self.bodies.pop(headers[applied + len(ready)].calculateHash(), None)
+                if block is None:
+                    break
+                ready.append(block)
+
+            if not ready:
+                if all(worker.done() for worker in self.workers):
+                    print("No peer left to sync from")
+                    return applied
+                self.arrived.clear()
+                await self.arrived.wait()
+                continue
+
+            count = await loop.run_in_executor(None, self.applyBlocks, ready)
+            applied += count
+            if count < len(ready):
+                return applied
+        return applied
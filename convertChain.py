@@ -0,0 +1,35 @@
+import sys
+
+from chainFormat import isBinaryChain
+from peer import Blockchain
+from storage import SQLITE_EXTENSIONS, SQLiteStorage
+
+# Converts a chain file between the ";;" text format and the binary format.
+# The input format is detected from the file, the output format is the other
+# one, or an SQLite database for a .db, .sqlite or .sqlite3 output.
+#
+#   python convertChain.py blockchain.txt blockchain.bin
+#   python convertChain.py blockchain.bin blockchain.txt
+#   python convertChain.py blockchain.txt blockchain.db
+
+
+def convertChain(inputFilename, outputFilename):
+    blockchain = Blockchain(inputFilename, miningWorkers = 1)
+    if outputFilename.endswith(SQLITE_EXTENSIONS):
+        storage = SQLiteStorage(outputFilename)
+        blockchain.saveToStore(storage)
+        storage.close()
+    elif isBinaryChain(inputFilename):
+        blockchain.saveBlockchain(outputFilename)
+    else:
+        blockchain.saveBlockchainBinary(outputFilename)
+    return blockchain
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python convertChain.py <input file> <output file>")
+        sys.exit(1)
+
+    blockchain = convertChain(sys.argv[1], sys.argv[2])
+    print("Converted", len(blockchain.chain), "blocks")
@@ -0,0 +1,225 @@
+import asyncio
+import collections
+import random
+
+import chainFormat
+from peerClient import AuthenticationError
+from wireProtocol import (
+    BLOCK, CHALLENGE, END, GETDATA, GETHEADERS, HEADERS, INV, RESPONSE,
+    ProtocolError, bytesToInt, decodeFields, intToBytes, readFrame, writeFrame
+)
+
+SEEN_LIMIT = 100000         # Block hashes remembered to drop duplicate announcements
+ORPHAN_LIMIT = 1000         # Blocks kept while their parent is fetched
+GOSSIP_TIMEOUT = 30         # Seconds to wait on a write to a peer
+KEEPALIVE_INTERVAL = 10     # Seconds between empty INVs, well under the server's SESSION_TIMEOUT
+RECONNECT_DELAY = 1         # Seconds before redialing a dropped link, doubled after each failed dial
+MAX_RECONNECT_DELAY = 60
+HASH_SIZE = 32
+MAX_HEADERS = 2000          # Headers sent per GETHEADERS, about 180KB
+GOSSIP_MESSAGES = (INV, GETDATA, BLOCK, GETHEADERS, HEADERS)
+LINK_ERRORS = (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ProtocolError, chainFormat.ChainFormatError)
+
+
+def encodeHashes(hashes):
+    return b"".join(bytes.fromhex(blockHash) for blockHash in hashes)
+
+
+def decodeHashes(payload):
+    if len(payload) % HASH_SIZE:
+        raise ProtocolError("Hash list isn't a multiple of 32 bytes")
+    return [bytes(payload[i:i + HASH_SIZE]).hex() for i in range(0, len(payload), HASH_SIZE)]
+
+
+async def authenticate(reader, writer, key):
+    # Client side of the challenge handshake with a peer server
+    randNum = random.randint(1000000000, 9999999999)
+    await writeFrame(writer, CHALLENGE, intToBytes(key.encrypt(randNum)), GOSSIP_TIMEOUT)
+    msgType, payload = await readFrame(reader, GOSSIP_TIMEOUT)
+    if msgType != RESPONSE or bytesToInt(payload) != randNum:
+        await writeFrame(writer, END, b"", GOSSIP_TIMEOUT)
+        raise AuthenticationError("Peer failed the challenge")
+
+    msgType, payload = await readFrame(reader, GOSSIP_TIMEOUT)
+    if msgType != CHALLENGE:
+        raise ProtocolError("Expected a challenge")
+    pt = key.decrypt(bytesToInt(payload))
+    await writeFrame(writer, RESPONSE, intToBytes(pt), GOSSIP_TIMEOUT)
+
+
+class GossipPeer:
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.writeLock = asyncio.Lock()
+
+    async def send(self, msgType, payload):
+        async with self.writeLock:
+            await writeFrame(self.writer, msgType, payload, GOSSIP_TIMEOUT)
+
+
+class Gossip:
+    # Spreads blocks between peers. A new block is announced by hash (INV),
+    # peers ask only for hashes they have neither seen nor stored (GETDATA)
+    # and get the encoded block back (BLOCK). A received block is checked by
+    # blockchain.receiveBlock and relayed once it is stored, on the chain or
+    # a side branch. Its hash then goes into a bounded seen-set so the same
+    # block is never fetched or relayed twice, as it does for an invalid
+    # block. A block whose parent we don't have is kept as an orphan, keyed
+    # by the parent's hash, and the parent is asked for from the same peer.
+
+    def __init__(self, blockchain, Block, Transaction):
+        self.blockchain = blockchain
+        self.Block = Block
+        self.Transaction = Transaction
+        self.seen = collections.OrderedDict()
+        self.orphans = collections.OrderedDict()
+        self.peers = set()
+        self.loop = None
+
+    def markSeen(self, blockHash):
+        # Returns False if the hash was already seen
+        if blockHash in self.seen:
+            return False
+        self.seen[blockHash] = True
+        if len(self.seen) > SEEN_LIMIT:
+            self.seen.popitem(last = False)
+        return True
+
+    def addOrphan(self, block):
+        # Returns True if the block's parent isn't being waited for yet
+        waiting = self.orphans.get(block.prevHash)
+        if waiting is not None:
+            if all(orphan.calculateHash() != block.calculateHash() for orphan in waiting):
+                waiting.append(block)
+            return False
+        self.orphans[block.prevHash] = [block]
+        if len(self.orphans) > ORPHAN_LIMIT:
+            self.orphans.popitem(last = False)
+        return True
+
+    def addPeer(self, peer):
+        self.peers.add(peer)
+
+    def removePeer(self, peer):
+        self.peers.discard(peer)
+
+    async def announce(self, blockHash, exclude = None):
+        payload = encodeHashes([blockHash])
+        for peer in list(self.peers):
+            if peer is exclude:
+                continue
+            try:
+                await peer.send(INV, payload)
+            except (asyncio.TimeoutError, ConnectionError):
+                self.removePeer(peer)
+
+    def announceFromThread(self, block):
+        # Block listener for blocks mined on another thread
+        blockHash = block.calculateHash()
+        if self.loop is None or not self.markSeen(blockHash):
+            return
+        asyncio.run_coroutine_threadsafe(self.announce(blockHash), self.loop)
+
+    async def handle(self, peer, msgType, payload):
+        if msgType == INV:
+            missing = [
+                blockHash for blockHash in decodeHashes(payload)
+                if blockHash not in self.seen and self.blockchain.findBlock(blockHash) is None
+            ]
+            if missing:
+                await peer.send(GETDATA, encodeHashes(missing))
+
+        elif msgType == GETDATA:
+            for blockHash in decodeHashes(payload):
+                block = self.blockchain.findBlock(blockHash)
+                if block is not None:
+                    await peer.send(BLOCK, chainFormat.encodeBlock(block))
+
+        elif msgType == GETHEADERS:
+            start, count = decodeFields(payload, 2)
+            blocks = self.blockchain.chain[start:start + min(count, MAX_HEADERS)]
+            await peer.send(HEADERS, b"".join(chainFormat.encodeHeader(block) for block in blocks))
+
+        elif msgType == BLOCK:
+            block, _ = chainFormat.decodeBlock(payload, 0, self.Block, self.Transaction)
+            # Never trust the hash sent along with the block
+            block.blockHash = None
+            await self.receive(peer, block)
+
+    async def receive(self, peer, block):
+        # Stores block and then any orphans waiting for it
+        loop = asyncio.get_running_loop()
+        pending = [block]
+        while pending:
+            block = pending.pop()
+            blockHash = block.calculateHash()
+            if blockHash in self.seen:
+                continue
+            await loop.run_in_executor(None, self.blockchain.receiveBlock, block)
+            if self.blockchain.findBlock(blockHash) is not None:
+                # Another session may have stored the same block meanwhile
+                if self.markSeen(blockHash):
+                    await self.announce(blockHash, exclude = peer)
+                pending.extend(self.orphans.pop(blockHash, []))
+            elif self.blockchain.findBlock(block.prevHash) is None:
+                if self.addOrphan(block):
+                    await peer.send(GETDATA, encodeHashes([block.prevHash]))
+            else:
+                self.markSeen(blockHash)
+
+    async def keepAlive(self, peer):
+        # The server drops sessions that stay silent for SESSION_TIMEOUT, an
+        # empty INV keeps an idle link open. Closing the writer when a send
+        # fails ends the read loop in connect.
+        try:
+            while True:
+                await asyncio.sleep(KEEPALIVE_INTERVAL)
+                await peer.send(INV, b"")
+        except (asyncio.TimeoutError, ConnectionError):
+            peer.writer.close()
+
+    async def connect(self, host, port, key):
+        # Opens an authenticated gossip link to a peer server and serves it
+        # until either side closes it. Raises if the link can't be opened.
+        self.loop = asyncio.get_running_loop()
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await authenticate(reader, writer, key)
+            peer = GossipPeer(writer)
+            self.addPeer(peer)
+            keepAlive = asyncio.create_task(self.keepAlive(peer))
+            try:
+                # An empty INV subscribes this session to the server's announcements
+                await peer.send(INV, b"")
+                while True:
+                    msgType, payload = await readFrame(reader)
+                    if msgType in GOSSIP_MESSAGES:
+                        await self.handle(peer, msgType, payload)
+            except asyncio.IncompleteReadError as error:
+                if error.partial:
+                    print("Gossip link to", (host, port), "dropped")
+            except LINK_ERRORS:
+                print("Gossip link to", (host, port), "dropped")
+            finally:
+                keepAlive.cancel()
+                self.removePeer(peer)
+        finally:
+            writer.close()
+
+    async def maintainLink(self, host, port, key):
+        # Keeps a gossip link to a peer server open, redialing whenever it
+        # drops. Failed dials back off exponentially up to MAX_RECONNECT_DELAY.
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await self.connect(host, port, key)
+                delay = RECONNECT_DELAY
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ProtocolError, AuthenticationError) as error:
+                print("Couldn't open a gossip link to", (host, port), ":", error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            await asyncio.sleep(delay)
+
@@ -13,6 +13,7 @@ opFile = open("authKey.txt", 'w');
 opString = ""
 
 opString = opString + str(e) + ";;" + str(d) + ";;" + str(n) 
+opString = opString + ";;" + str(p) + ";;" + str(q)
 opFile.write(opString)
 
 opFile.close()
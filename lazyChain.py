@@ -0,0 +1,111 @@
+import collections
+import mmap
+
+import chainFormat
+
+CACHE_SIZE = 1024       # Decoded blocks kept in memory
+
+
+def mapFile(filename):
+    with open(filename, 'rb') as ipFile:
+        return mmap.mmap(ipFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+def scanBlockOffsets(data):
+    # Walks the length prefixes of a binary chain file without decoding any
+    # block. Returns the (start, length) of every block record and the offset
+    # where the mempool section begins.
+    offset = chainFormat.checkHeader(data)
+    (blockCount,) = chainFormat.COUNT.unpack_from(data, offset)
+    offset += chainFormat.COUNT.size
+
+    offsets = []
+    for _ in range(blockCount):
+        (length,) = chainFormat.LENGTH.unpack_from(data, offset)
+        offset += chainFormat.LENGTH.size
+        offsets.append((offset, length))
+        offset += length
+    return offsets, offset
+
+
+class LazyChain:
+    # List-like view of the blocks of a memory-mapped file. Only the record
+    # offsets are kept, a block is decoded the first time it is accessed.
+    # Blocks appended later are kept in memory after the mapped ones.
+
+    def __init__(self, data, offsets, Block, Transaction):
+        self.data = data
+        self.offsets = offsets
+        self.Block = Block
+        self.Transaction = Transaction
+        self.appended = []
+        self.cache = collections.OrderedDict()
+        self.hashIndex = None
+
+    def __len__(self):
+        return len(self.offsets) + len(self.appended)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("chain index out of range")
+        if index >= len(self.offsets):
+            return self.appended[index - len(self.offsets)]
+        return self.decode(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def append(self, block):
+        self.appended.append(block)
+        if self.hashIndex is not None:
+            self.hashIndex[block.calculateHash()] = len(self) - 1
+
+    def pop(self):
+        # Drops the newest block, a mapped one is only forgotten
+        if self.appended:
+            block = self.appended.pop()
+        else:
+            if not self.offsets:
+                raise IndexError("pop from empty chain")
+            block = self.decode(len(self.offsets) - 1)
+            self.cache.pop(len(self.offsets) - 1, None)
+            self.offsets.pop()
+        if self.hashIndex is not None:
+            self.hashIndex.pop(block.calculateHash(), None)
+        return block
+
+    def decode(self, index):
+        block = self.cache.get(index)
+        if block is not None:
+            self.cache.move_to_end(index)
+            return block
+
+        start, _ = self.offsets[index]
+        block, _ = chainFormat.decodeBlock(self.data, start, self.Block, self.Transaction)
+        self.cache[index] = block
+        if len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last = False)
+        return block
+
+    def hashAt(self, index):
+        # Reads the stored hash of a mapped block without decoding the block
+        start, _ = self.offsets[index]
+        blockHash, _ = chainFormat.decodeHash(self.data, start + chainFormat.BLOCK_FIELDS.size)
+        return blockHash
+
+    def indexOfHash(self, blockHash):
+        # The hash -> index map is only built the first time it is needed
+        if self.hashIndex is None:
+            self.hashIndex = {self.hashAt(i): i for i in range(len(self.offsets))}
+            for i, block in enumerate(self.appended):
+                self.hashIndex[block.calculateHash()] = len(self.offsets) + i
+        return self.hashIndex.get(blockHash)
+
+    def close(self):
+        self.cache.clear()
+        self.data.close()
@@ -0,0 +1,67 @@
+import sys
+import tracemalloc
+
+from peer import Block, Node, Transaction
+
+# Compares the memory used by the slotted Transaction, Block and Node classes
+# with equivalent classes that keep a per-instance __dict__.
+#
+#   python memoryFootprint.py [number of transactions]
+
+
+class DictTransaction:
+    def __init__(self, senderId, receiverId, amount, nonce=None):
+        self.senderId = senderId
+        self.receiverId = receiverId
+        self.amount = amount
+        self.nonce = nonce
+
+
+class DictBlock:
+    def __init__(self, index, proofOfWorkNo, prevHash, uncommittedTransactions, timestamp=None, difficulty=None, merkleRoot=None):
+        self.index = index
+        self.proofOfWorkNo = proofOfWorkNo
+        self.prevHash = prevHash
+        self.uncommittedTransactions = uncommittedTransactions
+        self.timestamp = timestamp
+        self.difficulty = difficulty
+        self.merkleRoot = merkleRoot
+        self.blockHash = None
+
+
+class DictNode:
+    def __init__(self, nodeId, address, balance):
+        self.address = address
+        self.id = nodeId
+        self.balance = balance
+
+
+def measure(build, count):
+    # Bytes allocated per object, small ints are cached so only the
+    # objects themselves are counted
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    listSize = sys.getsizeof(objects)
+    del objects
+    return (after - before - listSize) / count
+
+
+def compare(count):
+    cases = [
+        ("Transaction", lambda i: DictTransaction(i % 100, (i + 1) % 100, 10), lambda i: Transaction(i % 100, (i + 1) % 100, 10)),
+        ("Block", lambda i: DictBlock(i % 100, 0, "0", None, 1.0, 16), lambda i: Block(i % 100, 0, "0", None, 1.0, 16)),
+        ("Node", lambda i: DictNode(i % 100, "127.0.0.1", 100), lambda i: Node(i % 100, "127.0.0.1", 100)),
+    ]
+    results = {}
+    for name, buildDict, buildSlots in cases:
+        results[name] = (measure(buildDict, count), measure(buildSlots, count))
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, (dictBytes, slotBytes) in compare(count).items():
+        print(f"{name:12} __dict__: {dictBytes:6.1f} bytes   __slots__: {slotBytes:6.1f} bytes")
@@ -0,0 +1,147 @@
+import hashlib
+import heapq
+import itertools
+import time
+
+MAX_TRANSACTIONS = 50000        # Pending transactions kept at most
+MAX_BYTES = 8 << 20             # Total serialized size of pending transactions kept at most
+BLOCK_MIN_TRANSACTIONS = 10     # Pending transactions that start mining a block
+BLOCK_MAX_TRANSACTIONS = 1000   # Transactions per block, besides the mining reward
+BLOCK_MAX_BYTES = 256 << 10     # Serialized size of a block's transactions
+BLOCK_MAX_DELAY = 30            # Seconds a transaction may wait before a smaller block is mined
+
+
+def transactionId(transaction):
+    return hashlib.sha256(transaction.toString().encode()).hexdigest()
+
+
+def transactionSize(transaction):
+    return len(transaction.toString())
+
+
+def amountPriority(transaction):
+    # The ledger has no fees, so larger transfers are kept and mined first
+    return transaction.amount
+
+
+class Mempool:
+    # Pending transactions in arrival order, one per transaction ID. A heap
+    # ordered by priority picks what to evict when the pool is over its
+    # count or byte limit, and blocks are assembled from the highest
+    # priority transactions. Heap entries of removed transactions are
+    # skipped when they come up.
+
+    def __init__(self, maxCount = MAX_TRANSACTIONS, maxBytes = MAX_BYTES, priority = amountPriority):
+        self.maxCount = maxCount
+        self.maxBytes = maxBytes
+        self.priority = priority
+        self.entries = {}       # Transaction ID -> (transaction, sequence, arrival time, priority, size)
+        self.bySender = {}      # Sender ID -> transaction IDs
+        self.byReceiver = {}    # Receiver ID -> transaction IDs
+        self.heap = []          # (priority, -sequence, transaction ID)
+        self.size = 0
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for entry in list(self.entries.values()):
+            yield entry[0]
+
+    def __contains__(self, transaction):
+        return transactionId(transaction) in self.entries
+
+    def add(self, transaction):
+        # Returns False for a transaction that is already pending
+        txId = transactionId(transaction)
+        if txId in self.entries:
+            return False
+        sequence = next(self.sequence)
+        priority = self.priority(transaction)
+        size = transactionSize(transaction)
+        self.entries[txId] = (transaction, sequence, time.time(), priority, size)
+        self.bySender.setdefault(transaction.senderId, set()).add(txId)
+        self.byReceiver.setdefault(transaction.receiverId, set()).add(txId)
+        heapq.heappush(self.heap, (priority, -sequence, txId))
+        self.size += size
+        return True
+
+    def remove(self, transaction):
+        return self.removeId(transactionId(transaction)) is not None
+
+    def removeId(self, txId):
+        entry = self.entries.pop(txId, None)
+        if entry is None:
+            return None
+        transaction = entry[0]
+        for accounts, accountId in ((self.bySender, transaction.senderId), (self.byReceiver, transaction.receiverId)):
+            txIds = accounts[accountId]
+            txIds.discard(txId)
+            if not txIds:
+                del accounts[accountId]
+        self.size -= entry[4]
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [item for item in self.heap if self.isLive(item)]
+            heapq.heapify(self.heap)
+        return transaction
+
+    def clear(self):
+        self.entries.clear()
+        self.bySender.clear()
+        self.byReceiver.clear()
+        self.heap = []
+        self.size = 0
+
+    def get(self, txId):
+        entry = self.entries.get(txId)
+        return None if entry is None else entry[0]
+
+    def accountTransactions(self, accountId):
+        # Pending transactions sent or received by accountId, newest first
+        txIds = self.bySender.get(accountId, set()) | self.byReceiver.get(accountId, set())
+        entries = sorted((self.entries[txId] for txId in txIds), key = lambda entry: entry[1], reverse = True)
+        return [entry[0] for entry in entries]
+
+    def isLive(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[1] == -item[1]
+
+    def isFull(self):
+        return len(self.entries) > self.maxCount or self.size > self.maxBytes
+
+    def popLowest(self):
+        while self.heap:
+            item = heapq.heappop(self.heap)
+            if self.isLive(item):
+                return self.removeId(item[2])
+        return None
+
+    def popLowestFrom(self, senderId):
+        # Removes the lowest priority transaction sent by senderId
+        txIds = self.bySender.get(senderId)
+        if not txIds:
+            return None
+        txId = min(txIds, key = lambda txId: (self.entries[txId][3], -self.entries[txId][1]))
+        return self.removeId(txId)
+
+    def oldestAge(self):
+        for entry in self.entries.values():
+            return time.time() - entry[2]
+        return 0
+
+    def readyToMine(self, minCount = BLOCK_MIN_TRANSACTIONS, maxDelay = BLOCK_MAX_DELAY):
+        return len(self.entries) >= minCount or (len(self.entries) > 0 and self.oldestAge() >= maxDelay)
+
+    def selectBlock(self, maxCount = BLOCK_MAX_TRANSACTIONS, maxBytes = BLOCK_MAX_BYTES):
+        # The highest priority transactions that fit, in arrival order
+        entries = heapq.nlargest(maxCount, self.entries.values(), key = lambda entry: (entry[3], -entry[1]))
+        selected = []
+        size = 0
+        for entry in entries:
+            if size + entry[4] > maxBytes:
+                continue
+            size += entry[4]
+            selected.append(entry)
+        selected.sort(key = lambda entry: entry[1])
+        return [entry[0] for entry in selected]
@@ -0,0 +1,60 @@
+import hashlib
+
+# Merkle tree over a block's transactions. Leaves and inner nodes are hashed
+# with different prefixes so a leaf can never pass for an inner node. A node
+# without a sibling moves up a level unchanged instead of being paired with
+# itself, so no two transaction lists share a root.
+#
+# An inclusion proof lists, from the leaf up, the sibling hash at each level
+# and whether that sibling is on the left. It is O(log n) hashes long.
+
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+EMPTY_ROOT = hashlib.sha256(b"").hexdigest()
+
+
+def leafHash(transaction):
+    return hashlib.sha256(LEAF_PREFIX + transaction.toString().encode()).digest()
+
+
+def nodeHash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def nextLevel(level):
+    parents = [nodeHash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkleRoot(transactions):
+    level = [leafHash(transaction) for transaction in transactions]
+    if not level:
+        return EMPTY_ROOT
+    while len(level) > 1:
+        level = nextLevel(level)
+    return level[0].hex()
+
+
+def merkleProof(transactions, index):
+    # Proof that transactions[index] is under merkleRoot(transactions)
+    level = [leafHash(transaction) for transaction in transactions]
+    if not 0 <= index < len(level):
+        raise IndexError("transaction index out of range")
+    proof = []
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append((level[sibling].hex(), sibling < index))
+        level = nextLevel(level)
+        index //= 2
+    return proof
+
+
+def verifyMerkleProof(transaction, proof, root):
+    current = leafHash(transaction)
+    for sibling, siblingIsLeft in proof:
+        sibling = bytes.fromhex(sibling)
+        current = nodeHash(sibling, current) if siblingIsLeft else nodeHash(current, sibling)
+    return current.hex() == root
@@ -0,0 +1,152 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+
+BATCH_SIZE = 4096       # Nonces tried between checks of the stop flag
+POLL_INTERVAL = 0.1     # Seconds between checks for a cancelled search
+WAKE_INTERVAL = 1       # Seconds between checks of the mempool's time limit
+JOIN_TIMEOUT = 5        # Seconds a worker gets to exit before it is terminated
+
+
+def searchNonces(prefix, target, start, step, stopped):
+    # Tries start, start + step, start + 2*step, ... so that every worker
+    # covers its own residue class of the nonce space, until stopped()
+    # returns True. The prefix is hashed once and the hash state copied
+    # for each nonce.
+    prefixHash = hashlib.sha256(prefix)
+    nonce = start
+    while not stopped():
+        for _ in range(BATCH_SIZE):
+            guessHash = prefixHash.copy()
+            guessHash.update(str(nonce).encode())
+            if int.from_bytes(guessHash.digest(), "big") < target:
+                return nonce
+            nonce += step
+    return None
+
+
+def searchWorker(tasks, results, currentJob):
+    # Worker process loop: searches each (job, prefix, target, start, step)
+    # task until it finds a nonce or currentJob moves off the job
+    for job, prefix, target, start, step in iter(tasks.get, None):
+        nonce = searchNonces(prefix, target, start, step, lambda: currentJob.value != job)
+        if nonce is not None:
+            results.put((job, nonce))
+
+
+class ParallelMiner:
+    # Keeps its worker processes between blocks. They are started on the
+    # first search from a spawn context, so nothing is forked from the
+    # node's threads. Each search is a numbered job, workers drop a job once
+    # currentJob no longer holds its number.
+
+    def __init__(self, workers = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.context = multiprocessing.get_context("spawn")
+        self.currentJob = self.context.Value("q", 0, lock = False)
+        self.results = self.context.Queue()
+        self.taskQueues = []
+        self.processes = []
+        self.job = 0
+        self.searchLock = threading.Lock()
+
+    def startWorkers(self):
+        if self.processes and all(process.is_alive() for process in self.processes):
+            return
+        self.close()
+        for _ in range(self.workers):
+            tasks = self.context.Queue()
+            process = self.context.Process(
+                target = searchWorker,
+                args = (tasks, self.results, self.currentJob),
+                daemon = True
+            )
+            process.start()
+            self.taskQueues.append(tasks)
+            self.processes.append(process)
+
+    def mine(self, prefix, target, cancelled = None):
+        # prefix is the encoded "blockString;;lastProof;;" part of the guess,
+        # a nonce wins when the hash read as a 256 bit number is below target.
+        # Returns the winning nonce, or None once cancelled() returns True.
+        with self.searchLock:
+            self.startWorkers()
+            self.job += 1
+            self.currentJob.value = self.job
+            for i, tasks in enumerate(self.taskQueues):
+                tasks.put((self.job, prefix, target, i, self.workers))
+
+            nonce = None
+            try:
+                while nonce is None and not (cancelled is not None and cancelled()):
+                    try:
+                        job, found = self.results.get(timeout = POLL_INTERVAL)
+                    except queue.Empty:
+                        continue
+                    # Results of earlier jobs can still be queued
+                    if job == self.job:
+                        nonce = found
+            finally:
+                self.currentJob.value = 0
+        return nonce
+
+    def close(self):
+        self.currentJob.value = 0
+        for tasks in self.taskQueues:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.taskQueues = []
+        self.processes = []
+
+
+class BackgroundMiner:
+    # Mines blocks on its own thread so admitting a transaction never waits
+    # for a proof of work. The blockchain wakes it when the mempool is ready
+    # to mine, and it checks the mempool's time limit on its own. The lock
+    # is only held to assemble and to seal a block, a block whose parent or
+    # transactions changed in between is dropped and assembled again. Mined
+    # blocks are delivered to blockchain.minedBlockListeners.
+
+    def __init__(self, blockchain, myId):
+        self.blockchain = blockchain
+        self.myId = myId
+        self.wakeEvent = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def wake(self):
+        self.wakeEvent.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeEvent.set()
+        self.blockchain.cancelMining()
+        if self.thread is not None:
+            self.thread.join()
+
+    def isReady(self):
+        with self.blockchain.lock:
+            return self.blockchain.uncommittedTransactions.readyToMine()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeEvent.wait(WAKE_INTERVAL)
+            self.wakeEvent.clear()
+            while not self.stopped.is_set() and self.isReady():
+                generation = self.blockchain.miningGeneration
+                block, parent = self.blockchain.prepareBlock(self.myId)
+                if len(block.uncommittedTransactions) < 2:
+                    # Only the mining reward, the pending transactions wait on each other
+                    break
+                proofOfWorkNo = self.blockchain.calculateProofOfWork(block, parent.proofOfWorkNo, generation)
+                if proofOfWorkNo is not None:
+                    self.blockchain.sealBlock(block, proofOfWorkNo, parent)
@@ -1,43 +1,96 @@
+import collections
 import hashlib
+import math
+import os
 import time
 import random
-import socket
+import threading
+
+import chainFormat
+from batchAdmission import DUPLICATE, EVICTED, INSUFFICIENT_FUNDS, checkTransactions
+from blockStore import BlockStore
+from lazyChain import LazyChain, mapFile, scanBlockOffsets
+from mempool import Mempool, transactionId
+from merkle import merkleProof, merkleRoot, verifyMerkleProof
+from miner import BackgroundMiner, ParallelMiner
+from peerClient import AuthenticationError, ConnectionPool
+from rsaKeys import loadAuthKey
+from storage import openStorage
+from txIndex import HISTORY_PAGE_SIZE, TransactionIndex
 
 HOST = '127.0.0.1' 
 PORT = 65432     
+MINING_WORKERS = os.cpu_count() or 1
+GOSSIP_PEERS = []           # (host, port) of peer servers to exchange blocks with
+
+LEGACY_DIFFICULTY = 16      # Blocks saved without a difficulty needed a "0000" hex prefix
+INITIAL_DIFFICULTY = 16     # Leading zero bits of the proof of work hash
+TARGET_BLOCK_TIME = 60      # Seconds
+RETARGET_INTERVAL = 10      # Blocks between difficulty adjustments
+MAX_RETARGET_STEP = 2       # Bits the difficulty may move per adjustment
+MAX_NONCE = 0xffffffff      # Transaction nonces are picked from 1 to MAX_NONCE
+UNDO_RECORDS = 1000         # Newest blocks whose balance changes are kept for reorganizations
+SIDE_BLOCK_DEPTH = 100      # Blocks below the tip a side block may be before it is dropped
+
+# Codes printed by validateNewBlock
+BLOCK_ERRORS = {
+    1: "index doesn't follow the previous block",
+    2: "previous hash doesn't match",
+    3: "invalid proof of work",
+    4: "timestamp isn't after the previous block",
+    5: "wrong difficulty",
+    6: "Merkle root missing or doesn't match the transactions",
+    7: "Merkle root without a difficulty",
+}
 
 class Transaction:
-    def __init__(self, senderId, receiverId, amount):
+    __slots__ = ("senderId", "receiverId", "amount", "nonce")
+
+    def __init__(self, senderId, receiverId, amount, nonce=None):
         self.senderId = senderId
         self.receiverId = receiverId
         self.amount = amount
+        self.nonce = nonce      # Tells repeated payments of the same amount apart
     
     def toString(self):
-        asString = '{' + str(self.senderId) + ',' + str(self.receiverId) 
-        asString = asString + ',' + str(self.amount) + '}'
-        return asString
+        # Part of every legacy block's hash, so it is built in one go
+        if self.nonce is None:
+            return f"{{{self.senderId},{self.receiverId},{self.amount}}}"
+        return f"{{{self.senderId},{self.receiverId},{self.amount},{self.nonce}}}"
         
 
 
 class Block:
+    __slots__ = ("index", "proofOfWorkNo", "prevHash", "uncommittedTransactions", "timestamp", "difficulty", "merkleRoot", "blockHash")
 
-    def __init__(self, index, proofOfWorkNo, prevHash, uncommittedTransactions, timestamp=None):
+    def __init__(self, index, proofOfWorkNo, prevHash, uncommittedTransactions, timestamp=None, difficulty=None, merkleRoot=None):
         self.index = index
         self.proofOfWorkNo = proofOfWorkNo
         self.prevHash = prevHash
         self.uncommittedTransactions = uncommittedTransactions
         self.timestamp = timestamp or time.time()
+        self.difficulty = difficulty
+        # Blocks with a Merkle root are hashed and mined on their header
+        # alone, older blocks on their full transaction list
+        self.merkleRoot = merkleRoot
+        self.blockHash = None
+
+    def getDifficulty(self):
+        if self.difficulty is None:
+            return LEGACY_DIFFICULTY
+        return self.difficulty
+
+    def getTarget(self):
+        # A proof is valid when the hash, read as a 256 bit number, is below the target
+        return 1 << (256 - self.getDifficulty())
+
+    def getWork(self):
+        # Expected number of hashes needed to find the proof
+        return 1 << self.getDifficulty()
 
     @staticmethod
     def uncommittedTransactionsToString(uncommittedTransactions):
-        string = ""
-        for i in range(len(uncommittedTransactions)):
-            transaction = uncommittedTransactions[i]
-            transactionAsString = transaction.toString()
-            string += transactionAsString
-            if i != len(uncommittedTransactions)-1:
-                string += ';'
-
+        string = ";".join([transaction.toString() for transaction in uncommittedTransactions])
         if string == "":
             return None
         else:
@@ -51,19 +104,45 @@ class Block:
         blockString = blockString + str(self.prevHash) + delimiter
         blockString = blockString + str(data) + delimiter
         blockString = blockString + str(self.timestamp)
+        if self.difficulty is not None:
+            blockString = blockString + delimiter + str(self.difficulty)
+        if self.merkleRoot is not None:
+            blockString = blockString + delimiter + self.merkleRoot
         if includeProofOfWorkNo :
             blockString = blockString + delimiter + str(self.proofOfWorkNo)
         
         return blockString
 
 
+    def headerString(self, includeProofOfWorkNo = True):
+        # The part of the block covered by its hash and proof of work
+        if self.merkleRoot is None:
+            return self.toString(includeProofOfWorkNo = includeProofOfWorkNo)
+        headerString = ";;".join((str(self.index), str(self.prevHash), self.merkleRoot, str(self.timestamp), str(self.difficulty)))
+        if includeProofOfWorkNo:
+            headerString = headerString + ";;" + str(self.proofOfWorkNo)
+        return headerString
+
+
     def calculateHash(self):
-        blockString = self.toString()
-        return hashlib.sha256(blockString.encode()).hexdigest()
+        # Blocks are not modified once sealed, so the hash is only computed once
+        if self.blockHash is None:
+            blockString = self.headerString()
+            self.blockHash = hashlib.sha256(blockString.encode()).hexdigest()
+        return self.blockHash
+
+
+    def calculateMerkleRoot(self):
+        return merkleRoot(self.uncommittedTransactions)
+
+
+    def toDict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
 
 
     
 class Node:
+    __slots__ = ("address", "id", "balance")
 
     def __init__(self, nodeId, address, balance):
         self.address = address
@@ -75,7 +154,7 @@ class Node:
             self.balance += amount
             return True
         else:
-            if amount > 0 and amount >= self.balance:
+            if amount > 0 and amount <= self.balance:
                 self.balance -= amount
                 return True
             else:
@@ -89,115 +168,467 @@ class Node:
 
 class Blockchain:
 
-    def __init__(self, filename = None):
+    def __init__(self, filename = None, miningWorkers = MINING_WORKERS, lazy = False):
         self.chain = []
-        self.uncommittedTransactions = []
+        self.uncommittedTransactions = Mempool()
         self.nodes = []
+        self.nodesById = {}
+        self.nodesByAddress = {}
+        self.blocksByHash = {}
+        self.sideBlocks = {}            # Valid blocks off the chain, by hash
+        self.txIndex = TransactionIndex()   # Account and transaction ID lookups for the chain
+        self.undoRecords = collections.OrderedDict()    # Block hash -> {node id: balance change}
+        self.lock = threading.RLock()   # Held by code that shares the chain between threads
+        self.miningGeneration = 0       # Moved on by cancelMining
+        self.minedBlockListeners = []   # Called with every block this node mines
+        self.miner = ParallelMiner(miningWorkers) if miningWorkers > 1 else None
+        self.backgroundMiner = None
+        self.encodedBlocks = None       # Block records of the last binary load or save, see chainFormat.encodeChain
+        self.targetBlockTime = TARGET_BLOCK_TIME
+        self.retargetInterval = RETARGET_INTERVAL
         
         if filename != None:
-            self.loadBlockchain(filename)
-        else:
-            self.addNewBlock(proofOfWorkNo = 0, prevHash = "0") #Genesis Block
+            # The backend is picked from the path, see storage.openStorage
+            self.loadFromStore(openStorage(filename), lazy)
+        if len(self.chain) == 0:
+            self.addNewBlock(proofOfWorkNo = 0, prevHash = "0", difficulty = INITIAL_DIFFICULTY) #Genesis Block
 
     def checkTransactionValidity(self, transaction):
         if transaction.senderId == transaction.receiverId:
             print("Error : Sender and receiver can't have same ID")
             return False
 
-        flag = 1
-        for node in self.nodes:
-            if node.id == transaction.receiverId:
-                flag = 0
-        
-        if flag == 1:
+        if transaction.receiverId not in self.nodesById:
             print("Error : Receiver doesn't exist")
             return False
 
-        flag = 1
-        for node in self.nodes:
-            if node.id == transaction.senderId:
-                flag = 0
-                if node.balance < transaction.amount:
-                    print("Error : Not sufficient funds")
-                    return False
-        
-        if flag == 1:
+        sender = self.nodesById.get(transaction.senderId)
+        if sender is None:
             print("Error : Sender doesn't exist")
             return False
+
+        if transaction.amount <= 0:
+            print("Error : Amount must be positive")
+            return False
+
+        if sender.balance < transaction.amount:
+            print("Error : Not sufficient funds")
+            return False
+
+        if transaction in self.uncommittedTransactions:
+            print("Error : Transaction is already pending")
+            return False
         
         return True
 
         
 
     def addNewTransaction(self, transaction):
+        # Returns True if the transaction was accepted, False if it was refused
         transactionCanBeMade = self.checkTransactionValidity(transaction)
-        if transactionCanBeMade:
-            self.uncommittedTransactions.append(transaction)
-            for node in self.nodes:
-                if node.id == transaction.senderId:
-                    node.makeTransaction(False, transaction.amount)
-                if node.id == transaction.receiverId:
-                    node.makeTransaction(True, transaction.amount)
-
-            data = None
-            if len(self.uncommittedTransactions) == 10:
+        if transactionCanBeMade and self.commitTransaction(transaction):
+            return True
+        print("Transaction NOT Possible")
+        return False
+
+
+    def addNewTransactions(self, transactions):
+        # Admits a batch in order, returns (accepted, rejected) where rejected
+        # holds (transaction, reason) pairs with the codes from batchAdmission
+        fresh = []
+        duplicates = []
+        txIds = set()
+        for transaction in transactions:
+            txId = transactionId(transaction)
+            if txId in txIds or transaction in self.uncommittedTransactions:
+                duplicates.append((transaction, DUPLICATE))
+            else:
+                txIds.add(txId)
+                fresh.append(transaction)
+
+        # The mempool limits are enforced once the whole batch is in, an
+        # eviction may take later transactions that depend on it along
+        checked, rejected = checkTransactions(self.nodesById, fresh)
+        admitted = []
+        for transaction in checked:
+            if self.admitTransaction(transaction):
+                admitted.append(transaction)
+            else:
+                rejected.append((transaction, INSUFFICIENT_FUNDS))
+        evicted = {id(transaction) for transaction in self.enforceMempoolLimits()}
+        accepted = [transaction for transaction in admitted if id(transaction) not in evicted]
+        rejected += [(transaction, EVICTED) for transaction in admitted if id(transaction) in evicted]
+        self.mineIfReady()
+        return accepted, rejected + duplicates
+
+
+    def admitTransaction(self, transaction):
+        # Adds a checked transaction to the mempool and moves its amount,
+        # returns False if it is already pending or the sender can't cover it
+        if not self.uncommittedTransactions.add(transaction):
+            return False
+        if not self.nodesById[transaction.senderId].makeTransaction(False, transaction.amount):
+            self.uncommittedTransactions.remove(transaction)
+            return False
+        self.nodesById[transaction.receiverId].makeTransaction(True, transaction.amount)
+        return True
+
+
+    def commitTransaction(self, transaction):
+        # Returns False if the transaction couldn't be admitted or was evicted
+        # straight away
+        if not self.admitTransaction(transaction):
+            return False
+        committed = True
+        if any(evicted is transaction for evicted in self.enforceMempoolLimits()):
+            print("Mempool full, transaction dropped")
+            committed = False
+        self.mineIfReady()
+        return committed
+
+
+    def mineIfReady(self):
+        # A block is mined once enough transactions are pending or the oldest
+        # has waited long enough, with as many as fit in a block. With a
+        # background miner running this returns at once.
+        data = None
+        if self.uncommittedTransactions.readyToMine():
+            if self.backgroundMiner is not None:
+                self.backgroundMiner.wake()
+            else:
                 global myNode
                 data = self.mineNewBlock(myId = myNode.id)
-            return data
+        return data
+
+
+    def startMining(self, myId):
+        # Moves mining off the threads that admit transactions
+        if self.backgroundMiner is None:
+            self.backgroundMiner = BackgroundMiner(self, myId)
+            self.backgroundMiner.start()
+
+
+    def stopMining(self):
+        if self.backgroundMiner is not None:
+            self.backgroundMiner.stop()
+            self.backgroundMiner = None
+        if self.miner is not None:
+            self.miner.close()
+
+
+    def enforceMempoolLimits(self):
+        # Evicts the lowest priority transactions while the mempool is over
+        # its limits and moves their amounts back. A receiver left unable to
+        # cover its own pending transactions loses those too, lowest priority
+        # first. Returns the evicted transactions.
+        evicted = []
+        while self.uncommittedTransactions.isFull():
+            transaction = self.uncommittedTransactions.popLowest()
+            self.applyBalanceChanges(self.balanceChanges([transaction]), -1)
+            evicted.append(transaction)
+            evicted += self.coverShortfalls([transaction.receiverId])
+        return evicted
+
+
+    def coverShortfalls(self, nodeIds):
+        # Evicts the lowest priority pending spends of the nodes left with a
+        # negative balance, and of the receivers those leave short in turn.
+        # Returns the evicted transactions.
+        evicted = []
+        stack = list(nodeIds)
+        while stack:
+            nodeId = stack.pop()
+            while self.nodesById[nodeId].balance < 0:
+                spend = self.uncommittedTransactions.popLowestFrom(nodeId)
+                if spend is None:
+                    break
+                self.applyBalanceChanges(self.balanceChanges([spend]), -1)
+                evicted.append(spend)
+                stack.append(spend.receiverId)
+        return evicted
+
+
+    def loadMempool(self, transactions):
+        # Saved balances already include the saved mempool, so the amounts of
+        # duplicates and of transactions over the limits are moved back
+        dropped = [transaction for transaction in transactions if not self.uncommittedTransactions.add(transaction)]
+        self.applyBalanceChanges(self.balanceChanges(dropped), -1)
+        self.enforceMempoolLimits()
+
+
+    def confirmedNodes(self, nodeIds = None):
+        # nodesById with the balances the chain alone gives, for checking
+        # blocks. With nodeIds only those of the nodes are included.
+        if nodeIds is None:
+            nodes = dict(self.nodesById)
         else:
-            print("Transaction NOT Possible")
+            nodes = {nodeId: self.nodesById[nodeId] for nodeId in nodeIds if nodeId in self.nodesById}
+        for nodeId, change in self.balanceChanges(self.uncommittedTransactions).items():
+            node = nodes.get(nodeId)
+            if node is None:
+                continue
+            nodes[nodeId] = Node(nodeId = node.id, address = node.address, balance = node.balance - change)
+        return nodes
+
+
+    def addNewBlock(self, proofOfWorkNo, prevHash, timestamp = None, difficulty = None, transactions = None):
+        # Seals transactions, by default the whole mempool, into a new block
+        if transactions is None:
+            transactions = list(self.uncommittedTransactions)
+            self.uncommittedTransactions.clear()
+        else:
+            for transaction in transactions:
+                self.uncommittedTransactions.remove(transaction)
 
-    def addNewBlock(self, proofOfWorkNo, prevHash, timestamp = None):
         block = Block(
             index=len(self.chain),
             proofOfWorkNo=proofOfWorkNo,
             prevHash=prevHash,
-            uncommittedTransactions=self.uncommittedTransactions,
-            timestamp = timestamp
+            uncommittedTransactions=transactions,
+            timestamp = timestamp,
+            difficulty = difficulty,
+            merkleRoot = merkleRoot(transactions)
         )
-        
-        self.uncommittedTransactions = []
 
+        self.appendBlock(block)
+        self.recordUndo(block)
+        return block
+
+
+    def appendBlock(self, block):
+        # self.chain doubles as the index -> block lookup
         self.chain.append(block)
+        self.blocksByHash[block.calculateHash()] = block
+        self.txIndex.addBlock(block)
+
+
+    def getBlockByHash(self, blockHash):
+        block = self.blocksByHash.get(blockHash)
+        if block is None and isinstance(self.chain, LazyChain):
+            index = self.chain.indexOfHash(blockHash)
+            if index is not None:
+                block = self.chain[index]
         return block
 
 
-    def validateNewBlock(self, block, prevBlock):
-        if prevBlock.index + 1 != block.index:
-            print(1)
+    def findBlock(self, blockHash):
+        # A stored block, on the chain or a side branch
+        block = self.getBlockByHash(blockHash)
+        if block is None:
+            block = self.sideBlocks.get(blockHash)
+        return block
+
+
+    def getBlockByIndex(self, index):
+        if 0 <= index < len(self.chain):
+            return self.chain[index]
+        return None
+
+
+    def getParent(self, block):
+        return self.getBlockByHash(block.prevHash)
+
+
+    def getAccountHistory(self, accountId, start = 0, count = HISTORY_PAGE_SIZE):
+        # A page of the transactions accountId sent or received, newest
+        # first, as (block index, transaction) pairs. Pending transactions
+        # come first with a block index of None. The next page starts at
+        # start + count.
+        with self.lock:
+            pending = self.uncommittedTransactions.accountTransactions(accountId)
+            history = [(None, transaction) for transaction in pending[start:start + count]]
+            if len(history) < count:
+                self.txIndex.catchUp(self.chain)
+                locations = self.txIndex.accountLocations(accountId, max(start - len(pending), 0), count - len(history))
+                for blockIndex, position in locations:
+                    history.append((blockIndex, self.chain[blockIndex].uncommittedTransactions[position]))
+            return history
+
+
+    def findTransaction(self, txId):
+        # Returns (block index, transaction) for a transactionId, with None
+        # for the block index of a pending transaction, or None if unknown
+        with self.lock:
+            transaction = self.uncommittedTransactions.get(txId)
+            if transaction is not None:
+                return None, transaction
+            self.txIndex.catchUp(self.chain)
+            for blockIndex, position in self.txIndex.locate(txId):
+                transaction = self.chain[blockIndex].uncommittedTransactions[position]
+                if transactionId(transaction) == txId:
+                    return blockIndex, transaction
+            return None
+
+
+    def getTransactionProof(self, blockHash, transaction):
+        # Returns a Merkle proof that transaction is in the block, or None.
+        # A client holding only the block's header checks it with
+        # verifyTransactionProof.
+        block = self.getBlockByHash(blockHash)
+        if block is None or block.merkleRoot is None:
+            return None
+        txId = transactionId(transaction)
+        for index, blockTransaction in enumerate(block.uncommittedTransactions):
+            if transactionId(blockTransaction) == txId:
+                return merkleProof(block.uncommittedTransactions, index)
+        return None
+
+
+    @staticmethod
+    def verifyTransactionProof(transaction, proof, header):
+        return header.merkleRoot is not None and verifyMerkleProof(transaction, proof, header.merkleRoot)
+
+
+    def validateNewBlock(self, block, prevBlock, headerOnly=False, getBlock=None):
+        # With headerOnly the block's transactions aren't checked. The proof
+        # of a block without a Merkle root can't be checked without them.
+        error = self.checkBlock(block, prevBlock, headerOnly, getBlock)
+        if error is not None:
+            print(error)
             return False
+        return True
+
+
+    def checkBlock(self, block, prevBlock, headerOnly=False, getBlock=None):
+        # Returns None for a valid block, otherwise one of the BLOCK_ERRORS codes
+        if prevBlock.index + 1 != block.index:
+            return 1
 
         elif prevBlock.calculateHash() != block.prevHash:
-            print(2)
-            return False
+            return 2
 
-        elif not self.verifyProof(block, prevBlock.proofOfWorkNo, block.proofOfWorkNo):
-            print(3)
-            return False
+        elif not self.checkDifficulty(block, prevBlock, getBlock):
+            return 5
+
+        elif prevBlock.merkleRoot is not None and block.merkleRoot is None:
+            # Blocks without a Merkle root can't follow blocks that have one
+            return 6
+
+        elif block.merkleRoot is not None and block.difficulty is None:
+            # blockchain.txt tells the two apart by the number of fields, a
+            # Merkle root alone would be read back as the difficulty
+            return 7
+
+        elif (not headerOnly or block.merkleRoot is not None) and not self.verifyProof(block, prevBlock.proofOfWorkNo, block.proofOfWorkNo):
+            return 3
+
+        elif not headerOnly and block.merkleRoot is not None and block.merkleRoot != block.calculateMerkleRoot():
+            return 6
 
         elif block.timestamp <= prevBlock.timestamp:
-            print(4)
-            return False
+            return 4
 
-        return True
+        return None
 
 
-    def calculateProofOfWork(self, newBlock, lastProof):
+    def validateChain(self, blocks=None, start=1):
+        # Checks blocks[start:] against their parents, recomputing every hash
+        # instead of trusting the cached ones. blocks is a run of consecutive
+        # blocks, by default the whole chain, that also holds the blocks
+        # retargeting looks back to. Returns (index, error code) of the first
+        # bad block or None.
+        if blocks is None:
+            blocks = self.chain
+        if start >= len(blocks):
+            return None
+        firstIndex = blocks[0].index
+
+        def getBlock(index):
+            return blocks[index - firstIndex]
+
+        prevBlock = blocks[start - 1]
+        prevBlock.blockHash = None
+        for i in range(start, len(blocks)):
+            block = blocks[i]
+            block.blockHash = None
+            error = self.checkBlock(block, prevBlock, getBlock = getBlock)
+            if error is not None:
+                return block.index, error
+            prevBlock = block
+        return None
+
+
+    def checkDifficulty(self, block, prevBlock, getBlock=None):
+        if block.difficulty is None:
+            # Blocks without a stored difficulty can't follow blocks that have one
+            return prevBlock.difficulty is None
+        return block.difficulty == self.nextDifficulty(prevBlock, getBlock)
+
+
+    def nextDifficulty(self, prevBlock, getBlock=None):
+        # getBlock(index) looks up earlier blocks of the branch being checked,
+        # by default our own chain
+        difficulty = prevBlock.getDifficulty()
+        height = prevBlock.index + 1
+        if height < self.retargetInterval or height % self.retargetInterval != 0:
+            return difficulty
+
+        # Compare the time the last interval took with the time it should have taken
+        firstBlock = (getBlock or self.getBlockByIndex)(height - self.retargetInterval)
+        actualTime = max(prevBlock.timestamp - firstBlock.timestamp, 1e-6)
+        expectedTime = self.targetBlockTime * (self.retargetInterval - 1)
+        step = round(math.log2(expectedTime / actualTime))
+        step = max(-MAX_RETARGET_STEP, min(MAX_RETARGET_STEP, step))
+
+        return max(1, min(255, difficulty + step))
+
+
+    def calculateProofOfWork(self, newBlock, lastProof, generation = None):
+        # Returns None if cancelMining is called once miningGeneration was
+        # read as generation. Callers read it before prepareBlock, so a
+        # cancel that comes before the search starts isn't lost.
+        if generation is None:
+            generation = self.miningGeneration
+        cancelled = lambda: self.miningGeneration != generation
+        prefix = self.proofPrefix(newBlock, lastProof)
+        target = newBlock.getTarget()
+        if self.miner is not None:
+            return self.miner.mine(prefix, target, cancelled)
+
+        # Hash the fixed prefix once and only feed the nonce for each attempt
+        prefixHash = hashlib.sha256(prefix)
         proofOfWorkNo = 0
-        while self.verifyProof(newBlock, lastProof, proofOfWorkNo) is False:
+        while True:
+            if proofOfWorkNo % 4096 == 0 and cancelled():
+                return None
+            guessHash = prefixHash.copy()
+            guessHash.update(str(proofOfWorkNo).encode())
+            if int.from_bytes(guessHash.digest(), "big") < target:
+                return proofOfWorkNo
             proofOfWorkNo += 1
 
-        return proofOfWorkNo
+
+    def cancelMining(self):
+        # Abandon the current proof of work search, e.g. when a competing block arrives
+        self.miningGeneration += 1
 
     
+    def proofPrefix(self, currentBlock, lastProof):
+        blockAsString = currentBlock.headerString(includeProofOfWorkNo = False)
+        return f'{blockAsString};;{lastProof};;'.encode()
+
+
     def verifyProof(self, currentBlock, lastProof, newProof):
-        blockAsString = currentBlock.toString(includeProofOfWorkNo = False)
-        guess = f'{blockAsString};;{lastProof};;{newProof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        guess = self.proofPrefix(currentBlock, lastProof) + str(newProof).encode()
+        guess_hash = hashlib.sha256(guess).digest()
+        return int.from_bytes(guess_hash, "big") < currentBlock.getTarget()
 
 
     def mineNewBlock(self, myId):
+        generation = self.miningGeneration
+        block, latestBlock = self.prepareBlock(myId)
+        proofOfWorkNo = self.calculateProofOfWork(newBlock = block, lastProof = latestBlock.proofOfWorkNo, generation = generation)
+        if proofOfWorkNo is None:
+            return None
+
+        block = self.sealBlock(block, proofOfWorkNo, latestBlock)
+        if block is None:
+            return None
+        return block.toDict()
+
+
+    def prepareBlock(self, myId):
+        # Returns a block to mine on the current tip and the tip
 
         miningTransaction = Transaction(
             senderId = "0", 
@@ -205,44 +636,296 @@ class Blockchain:
             amount = 1
         )
 
+        with self.lock:
+            latestBlock = self.chain[-1]
+            lastHash = latestBlock.calculateHash()
+
+            # The highest priority pending transactions that are valid in order
+            # on the chain alone, those waiting on funds that are still pending
+            # stay for a later block
+            transactions, _ = checkTransactions(self.confirmedNodes(), self.uncommittedTransactions.selectBlock())
+            transactions.append(miningTransaction)
+
+            timestamp = time.time()
+            difficulty = self.nextDifficulty(latestBlock)
+            block = Block(
+                    index=len(self.chain),
+                    proofOfWorkNo = 0,
+                    prevHash=lastHash,
+                    uncommittedTransactions=transactions,
+                    timestamp = timestamp,
+                    difficulty = difficulty,
+                    merkleRoot = merkleRoot(transactions)
+            )
+        return block, latestBlock
+
+
+    def sealBlock(self, block, proofOfWorkNo, latestBlock):
+        # Adds a mined block if the chain and the block's transactions are
+        # unchanged since prepareBlock, returns the added block or None
+        with self.lock:
+            if self.chain[-1] is not latestBlock:
+                return None
+            for transaction in block.uncommittedTransactions[:-1]:
+                if transaction not in self.uncommittedTransactions:
+                    return None
+
+            block = self.addNewBlock(proofOfWorkNo, block.prevHash, block.timestamp, block.difficulty, block.uncommittedTransactions)
+            for listener in self.minedBlockListeners:
+                listener(block)
+        return block
+
+
+    def receiveBlock(self, block):
+        # Adds a block mined by another peer. A block that doesn't extend our
+        # tip is kept on a side branch, see receiveSideBlock.
+        blockHash = block.calculateHash()
+        if blockHash in self.blocksByHash or blockHash in self.sideBlocks:
+            return False
         latestBlock = self.chain[-1]
-        lastHash = latestBlock.calculateHash()
+        if block.prevHash != latestBlock.calculateHash():
+            return self.receiveSideBlock(block)
+        if not self.validateNewBlock(block, latestBlock):
+            return False
+
+        # Stop mining on the old tip so the lock is released sooner
+        self.cancelMining()
+        with self.lock:
+            if self.chain[-1] is latestBlock:
+                if not self.applyBlockTransactions(block):
+                    return False
+                self.appendBlock(block)
+                self.recordUndo(block)
+                return True
+        # The tip moved while the block was validated, it now forks off the chain
+        return self.receiveSideBlock(block)
 
-        self.uncommittedTransactions.append(miningTransaction)
 
-        
+    def receiveSideBlock(self, block):
+        # Keeps a valid block that forks off the chain and reorganizes to its
+        # branch once that has more work than the chain after the fork point.
+        # Returns True only if the block ends up on the chain.
+        if block.index < len(self.chain) - SIDE_BLOCK_DEPTH:
+            print("Block", block.index, "is too far below the tip")
+            return False
+        forkBlock, branch = self.findBranch(block)
+        if forkBlock is None:
+            print("Block", block.index, "doesn't connect to the chain")
+            return False
+        if not self.validateNewBlock(block, branch[-2] if len(branch) > 1 else forkBlock, getBlock = self.branchLookup(forkBlock, branch)):
+            return False
 
-        lastProofOfWorkNo = latestBlock.proofOfWorkNo
-        timestamp = time.time()
-        block = Block(
-                index=len(self.chain),
-                proofOfWorkNo = 0,
-                prevHash=lastHash,
-                uncommittedTransactions=self.uncommittedTransactions,
-                timestamp = timestamp
+        if not self.isHeavier(forkBlock, branch):
+            with self.lock:
+                self.addSideBlock(block)
+            return False
+
+        self.cancelMining()
+        with self.lock:
+            # The chain may have moved while the lock was free
+            forkBlock, branch = self.findBranch(block)
+            if forkBlock is None or not self.isHeavier(forkBlock, branch):
+                self.addSideBlock(block)
+                return False
+            return self.reorganize(forkBlock, branch)
+
+
+    def addSideBlock(self, block):
+        # Keeps block and drops the side blocks that have fallen more than
+        # SIDE_BLOCK_DEPTH below the tip, so stale forks can't pile up
+        self.sideBlocks[block.calculateHash()] = block
+        lowest = len(self.chain) - SIDE_BLOCK_DEPTH
+        stale = [blockHash for blockHash, sideBlock in self.sideBlocks.items() if sideBlock.index < lowest]
+        for blockHash in stale:
+            del self.sideBlocks[blockHash]
+
+
+    def findBranch(self, block):
+        # Returns the chain block the branch ending in block forks from and
+        # the branch's blocks oldest first, or (None, None) if it doesn't
+        # lead back to the chain
+        branch = [block]
+        while branch[-1].prevHash in self.sideBlocks:
+            branch.append(self.sideBlocks[branch[-1].prevHash])
+        forkBlock = self.getBlockByHash(branch[-1].prevHash)
+        if forkBlock is None:
+            return None, None
+        branch.reverse()
+        return forkBlock, branch
+
+
+    def branchLookup(self, forkBlock, branch):
+        # getBlock for nextDifficulty along a branch
+        def getBlock(index):
+            if index > forkBlock.index:
+                return branch[index - forkBlock.index - 1]
+            return self.getBlockByIndex(index)
+        return getBlock
+
+
+    def isHeavier(self, forkBlock, branch):
+        # Only the blocks after the fork point differ, so this costs time in
+        # proportion to the depth of the fork. Ties keep the chain.
+        branchWork = sum(block.getWork() for block in branch)
+        chainWork = sum(self.chain[i].getWork() for i in range(forkBlock.index + 1, len(self.chain)))
+        return branchWork > chainWork
+
+
+    def reorganize(self, forkBlock, branch):
+        # Switches the chain to branch. Balances are moved back to the fork
+        # point with the undo records of the disconnected blocks, then forward
+        # with each branch block. If a branch block turns out to be invalid
+        # the old chain is restored. Transactions of the old blocks that the
+        # branch doesn't have go back to the mempool.
+        mempool = list(self.uncommittedTransactions)
+        # Balances include the mempool, take it out to get those of the tip
+        self.applyBalanceChanges(self.balanceChanges(mempool), -1)
+
+        disconnected = []
+        while len(self.chain) - 1 > forkBlock.index:
+            disconnected.append(self.disconnectBlock())
+
+        connected = []
+        for block in branch:
+            if not self.connectBlock(block):
+                print("Block", block.index, "of the new branch is invalid, keeping the chain")
+                for invalid in branch[len(connected):]:
+                    self.sideBlocks.pop(invalid.calculateHash(), None)
+                for _ in connected:
+                    self.disconnectBlock()
+                for oldBlock in reversed(disconnected):
+                    self.connectBlock(oldBlock)
+                self.applyBalanceChanges(self.balanceChanges(mempool), 1)
+                return False
+            connected.append(block)
+
+        included = collections.Counter(
+            transactionId(transaction) for block in connected for transaction in block.uncommittedTransactions
         )
+        candidates = []
+        for transaction in [t for block in reversed(disconnected) for t in block.uncommittedTransactions] + mempool:
+            txId = transactionId(transaction)
+            if str(transaction.senderId) == "0":
+                continue
+            if included[txId] > 0:
+                included[txId] -= 1
+            else:
+                candidates.append(transaction)
 
-        proofOfWorkNo = self.calculateProofOfWork(newBlock = block, lastProof = lastProofOfWorkNo)
+        self.uncommittedTransactions.clear()
+        accepted, rejected = checkTransactions(self.nodesById, candidates)
+        self.applyBalanceChanges(self.balanceChanges(accepted), 1)
+        self.loadMempool(accepted)
+        print("Reorganized", len(disconnected), "blocks, new tip", self.chain[-1].index, "-", len(rejected), "transactions dropped\n")
+        return True
 
-        
-        block = self.addNewBlock(proofOfWorkNo, lastHash, timestamp)
 
-        return vars(block)
+    def connectBlock(self, block):
+        # Appends block if its transactions can be made from the balances of
+        # the current tip, which must not include the mempool
+        transactions = [transaction for transaction in block.uncommittedTransactions if str(transaction.senderId) != "0"]
+        accepted, rejected = checkTransactions(self.nodesById, transactions)
+        if rejected:
+            return False
+        changes = self.balanceChanges(transactions)
+        self.applyBalanceChanges(changes, 1)
+        self.sideBlocks.pop(block.calculateHash(), None)
+        self.appendBlock(block)
+        self.recordUndo(block, changes)
+        return True
+
+
+    def disconnectBlock(self):
+        # Removes the tip, undoing its balance changes, and keeps it as a side block
+        block = self.chain.pop()
+        blockHash = block.calculateHash()
+        self.blocksByHash.pop(blockHash, None)
+        self.txIndex.removeBlock(block)
+        changes = self.undoRecords.pop(blockHash, None)
+        if changes is None:
+            # Records of old blocks aren't kept, they are rebuilt from the block
+            changes = self.balanceChanges(block.uncommittedTransactions)
+        self.applyBalanceChanges(changes, -1)
+        self.sideBlocks[blockHash] = block
+        return block
+
+
+    def recordUndo(self, block, changes = None):
+        if changes is None:
+            changes = self.balanceChanges(block.uncommittedTransactions)
+        self.undoRecords[block.calculateHash()] = changes
+        if len(self.undoRecords) > UNDO_RECORDS:
+            self.undoRecords.popitem(last = False)
+
+
+    @staticmethod
+    def balanceChanges(transactions):
+        # Net change per node id, the mining reward isn't credited
+        changes = {}
+        for transaction in transactions:
+            if str(transaction.senderId) == "0":
+                continue
+            changes[transaction.senderId] = changes.get(transaction.senderId, 0) - transaction.amount
+            changes[transaction.receiverId] = changes.get(transaction.receiverId, 0) + transaction.amount
+        return changes
+
+
+    def applyBalanceChanges(self, changes, sign):
+        for nodeId, change in changes.items():
+            self.nodesById[nodeId].balance += sign * change
+
+
+    def applyBlockTransactions(self, block):
+        # The block's transactions are checked against the balances the chain
+        # alone gives, so a block may spend funds our own pending
+        # transactions spend too. Those already in our mempool have moved
+        # their amounts, the others are applied now, then pending
+        # transactions the block left unfunded are evicted as reorganize
+        # does. The mining reward isn't credited, as for blocks mined here.
+        transactions = [transaction for transaction in block.uncommittedTransactions if str(transaction.senderId) != "0"]
+        nodeIds = {nodeId for transaction in transactions for nodeId in (transaction.senderId, transaction.receiverId)}
+        _, rejected = checkTransactions(self.confirmedNodes(nodeIds), transactions)
+        if rejected:
+            return False
+
+        newTransactions = []
+        for transaction in transactions:
+            if not self.uncommittedTransactions.remove(transaction):
+                newTransactions.append(transaction)
+        self.applyBalanceChanges(self.balanceChanges(newTransactions), 1)
+        evicted = self.coverShortfalls({transaction.senderId for transaction in newTransactions})
+        if evicted:
+            print(len(evicted), "pending transactions conflict with block", block.index, "and were dropped")
+        return True
 
 
     def addNode(self, nodeId, address, balance):
-        for node in self.nodes:
-            if node.id == nodeId:
-                print("Node ID already used")
-                return False
-            if node.address == address:
-                print("Node address already used")
-                return False
+        if nodeId in self.nodesById:
+            print("Node ID already used")
+            return False
+        if address in self.nodesByAddress:
+            print("Node address already used")
+            return False
         newNode = Node(nodeId = nodeId, address = address, balance = balance)
-        self.nodes.append(newNode)
+        self.registerNode(newNode)
         return True
 
 
+    def registerNode(self, node):
+        # self.nodes keeps the saved order, the dicts give O(1) lookups
+        self.nodes.append(node)
+        self.nodesById[node.id] = node
+        self.nodesByAddress[node.address] = node
+
+
+    def getNode(self, nodeId):
+        return self.nodesById.get(nodeId)
+
+
+    def getNodeByAddress(self, address):
+        return self.nodesByAddress.get(address)
+
+
     def toString(self):
         blockchainString = ''
 
@@ -261,7 +944,8 @@ class Blockchain:
         newTransaction = Transaction(
             senderId = int(attributes[0]), 
             receiverId = int(attributes[1]), 
-            amount = int(attributes[2])
+            amount = int(attributes[2]),
+            nonce = int(attributes[3]) if len(attributes) > 3 else None
         )
         return newTransaction
 
@@ -290,13 +974,22 @@ class Blockchain:
             if transactionString != "None":
                 transaction = self.transactionFromString(transactionString)
                 uncommittedTransactions.append(transaction)
+
+        difficulty = None
+        if len(attributes) >= 6:
+            difficulty = int(attributes[4])
+        merkleRootString = None
+        if len(attributes) == 7:
+            merkleRootString = attributes[5]
         
         block = Block(
             index = int(attributes[0]),
             prevHash = attributes[1],
             uncommittedTransactions = uncommittedTransactions,
             timestamp = float(attributes[3]),
-            proofOfWorkNo = int(attributes[4]),
+            proofOfWorkNo = int(attributes[-1]),
+            difficulty = difficulty,
+            merkleRoot = merkleRootString
         )
 
         return block
@@ -314,15 +1007,15 @@ class Blockchain:
         if nodesString != "None":
             nodes = nodesString.split(";")
             for node in nodes:
-                self.nodes.append(self.nodeFromString(node))
+                self.registerNode(self.nodeFromString(node))
 
-        uncommittedTransactions = uncommittedTransactionsString.split(';')
-        for transaction in uncommittedTransactions:
-            self.uncommittedTransactions.append(self.transactionFromString(transaction))
+        if uncommittedTransactionsString != "None":
+            uncommittedTransactions = uncommittedTransactionsString.split(';')
+            self.loadMempool([self.transactionFromString(transaction) for transaction in uncommittedTransactions])
 
         blocks = blockchainString.split(";;;")
         for block in blocks:
-            self.chain.append(self.blockFromString(block))
+            self.appendBlock(self.blockFromString(block))
 
         ipFile.close()
 
@@ -345,7 +1038,7 @@ class Blockchain:
     def saveBlockchain(self, filename = "blockchain.txt"):
         opFile = open(filename, 'w')
         blockchainString = str(self.toString())
-        uncommittedTransactionsString = str(Block.uncommittedTransactionsToString(self.uncommittedTransactions))
+        uncommittedTransactionsString = str(Block.uncommittedTransactionsToString(list(self.uncommittedTransactions)))
         nodesString = str(self.nodesToString())
 
         data = blockchainString + ";;;;" + uncommittedTransactionsString + ";;;;" + nodesString
@@ -355,6 +1048,46 @@ class Blockchain:
         opFile.close()
 
 
+    def loadBlockchainBinary(self, filename = "blockchain.bin", trusted = False):
+        # With trusted the stored block hashes are taken as they are
+        with open(filename, 'rb') as ipFile:
+            self.encodedBlocks = chainFormat.decodeChain(ipFile.read(), self, Block, Transaction, Node, trusted)
+
+
+    def saveBlockchainBinary(self, filename = "blockchain.bin"):
+        # Only the blocks added since the last binary load or save are encoded
+        data, self.encodedBlocks = chainFormat.encodeChain(self, self.encodedBlocks)
+        with open(filename, 'wb') as opFile:
+            opFile.write(data)
+
+
+    def loadBlockchainLazy(self, filename):
+        # Maps a binary chain file or a block store, only the mempool and
+        # nodes are decoded up front
+        if os.path.isdir(filename):
+            self.loadFromStore(BlockStore(filename), lazy = True)
+            return
+
+        data = mapFile(filename)
+        offsets, offset = scanBlockOffsets(data)
+        self.chain = LazyChain(data, offsets, Block, Transaction)
+        transactions, offset = chainFormat.decodeTransactions(data, offset, Transaction)
+        nodes, offset = chainFormat.decodeNodes(data, offset, Node)
+        for node in nodes:
+            self.registerNode(node)
+        self.loadMempool(transactions)
+
+
+    def loadFromStore(self, store, lazy = False):
+        store.load(self, Block, Transaction, Node, lazy)
+
+
+    def saveToStore(self, store):
+        # With a BlockStore or an SQLiteStorage only the blocks sealed since
+        # the last save are written
+        store.save(self)
+
+
 
 def loadMyDetails():
     nodeDetialsFile = open("my-details.txt", 'r')
@@ -384,57 +1117,68 @@ def decrypt(ct, d, N):
     return pow(ct, d, N)
 
 
+def getConnectionPool():
+    global connectionPool
+    if connectionPool is None:
+        connectionPool = ConnectionPool(myNode.id, loadAuthKey())
+    return connectionPool
+
+
 def initComm(send, amount):
+    return initCommMany([(send, amount)])[0]
+
+
+def initCommMany(requests):
+    # Pipelines (send, amount) requests over one pooled session with the
+    # peer, returns whether each one was accepted
     global myNode
     global newChain
-    authKeyFile = open("authKey.txt", 'r')
-    contents = authKeyFile.read()
-    contents = contents.split(";;")
-    e = int(contents[0])
-    d = int(contents[1])
-    N = int(contents[2])
-
-    randNum = random.randint(1000000000, 9999999999)
-    ct = encrypt(randNum, e, N)
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((HOST, PORT))
-        s.sendall(ct.to_bytes(2048, "big"))
-        data = s.recv(2048)
-        data = int.from_bytes(data, "big")
-        
-        if data == randNum:
-            print("User Authenticated\n")
-            ct = s.recv(2048)
-            ct = int.from_bytes(ct, "big")
-            pt = decrypt(ct, d, N)
-            s.sendall(pt.to_bytes(2048, "big"))
-
-            if send:
-                print("Sending\n")
-                s.sendall(b'send')
-                s.sendall(myNode.id.to_bytes(1024, "big"))
-                s.sendall(amount.to_bytes(1024, "big"))
-            else:
-                print("Requesting\n")
-                s.sendall(b'request')
-                s.sendall(myNode.id.to_bytes(1024, "big"))
-                s.sendall(amount.to_bytes(1024, "big"))
-            
-            status = s.recv(1024)
-            if status == b'Accept':
-                otherPeerId = int.from_bytes(s.recv(1024), "big")
-                transaction = Transaction(myNode.id, otherPeerId, amount) if send else  Transaction(otherPeerId, myNode.id, amount)
-                newChain.addNewTransaction(transaction)
+
+    pool = getConnectionPool()
+    nonces = [random.randint(1, MAX_NONCE) for _ in requests]
+    futures = []
+    connection = None
+    redialed = False
+    try:
+        for (send, amount), nonce in zip(requests, nonces):
+            while True:
+                try:
+                    if connection is None:
+                        connection = pool.get(HOST, PORT)
+                        print("User Authenticated\n")
+                    futures.append(connection.submit(send, amount, nonce))
+                    break
+                except OSError:
+                    # The peer server closes idle pooled sessions, so a pooled
+                    # connection may be gone. Redial once, requests already
+                    # sent on it fail with it.
+                    if connection is not None:
+                        pool.discard(HOST, PORT, connection)
+                        connection = None
+                    if redialed:
+                        raise
+                    redialed = True
+    except AuthenticationError:
+        print("Unauthorized Peer")
+    except OSError:
+        print("Couldn't reach the peer")
+
+    results = []
+    for index, ((send, amount), nonce) in enumerate(zip(requests, nonces)):
+        try:
+            otherPeerId = futures[index].result() if index < len(futures) else None
+        except ConnectionError:
+            otherPeerId = None
+        if otherPeerId is not None:
+            transaction = Transaction(myNode.id, otherPeerId, amount, nonce) if send else  Transaction(otherPeerId, myNode.id, amount, nonce)
+            accepted = newChain.addNewTransaction(transaction)
+            if accepted:
                 print("Transaction Made")
-            else:
-                print("Error")
+            results.append(accepted)
         else:
-            ct = s.recv(2048)
-            s.sendall(b'End connection')
-            return
-        # print('Received', repr(data))
-    print("Connection Terminated...")
+            print("Error")
+            results.append(False)
+    return results
     #TODO send randNum, receive decypted and one diff encrypted random no, send decrypted 
     # if ptRec == randNum:
     #   ctRec = receiveNo()
@@ -445,11 +1189,14 @@ def initComm(send, amount):
 
 
 
-myNode = loadMyDetails()
-# newChain = Blockchain()
-newChain = Blockchain("blockchain.txt")
+connectionPool = None
+
+if __name__ == "__main__":
+    myNode = loadMyDetails()
+    # newChain = Blockchain()
+    newChain = Blockchain("blockchain.txt")
 
-initComm(True, 10)
+    initComm(True, 10)
 
 # newChain.addNode(myNode.id, myNode.address, myNode.balance)
 # newChain.addNode(14, "123.123.123.132", 456)
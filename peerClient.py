@@ -0,0 +1,137 @@
+import itertools
+import random
+import socket
+import threading
+from concurrent.futures import Future
+
+from wireProtocol import (
+    ACCEPT, CHALLENGE, END, REJECT, REQUEST, RESPONSE, SEND,
+    ProtocolError, bytesToInt, decodeFields, encodeFields, intToBytes, recvFrame, sendFrame
+)
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class PeerConnection:
+    # One authenticated session with a peer. Any number of send/request
+    # messages can be in flight at once, each tagged with a request ID that
+    # the peer echoes back in its ACCEPT or REJECT.
+
+    def __init__(self, host, port, myId, key):
+        self.address = (host, port)
+        self.myId = myId
+        self.requestIds = itertools.count(1)
+        self.pending = {}
+        self.sendLock = threading.Lock()
+        self.closed = False
+
+        self.sock = socket.create_connection(self.address)
+        try:
+            self.authenticate(key)
+        except BaseException:
+            self.sock.close()
+            raise
+
+        self.readerThread = threading.Thread(target = self.readResponses, daemon = True)
+        self.readerThread.start()
+
+    def authenticate(self, key):
+        randNum = random.randint(1000000000, 9999999999)
+        sendFrame(self.sock, CHALLENGE, intToBytes(key.encrypt(randNum)))
+        msgType, payload = recvFrame(self.sock)
+        if msgType != RESPONSE or bytesToInt(payload) != randNum:
+            recvFrame(self.sock)
+            sendFrame(self.sock, END)
+            raise AuthenticationError("Peer failed the challenge")
+
+        msgType, payload = recvFrame(self.sock)
+        if msgType != CHALLENGE:
+            raise ProtocolError("Expected a challenge")
+        sendFrame(self.sock, RESPONSE, intToBytes(key.decrypt(bytesToInt(payload))))
+
+    def submit(self, send, amount, nonce = None):
+        # Returns a Future for the peer's ID if accepted, None if rejected.
+        # The nonce is sent along so both sides record the same transaction.
+        future = Future()
+        with self.sendLock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            requestId = next(self.requestIds)
+            self.pending[requestId] = future
+            fields = [requestId, self.myId, amount] + ([] if nonce is None else [nonce])
+            sendFrame(self.sock, SEND if send else REQUEST, encodeFields(*fields))
+        return future
+
+    def readResponses(self):
+        try:
+            while True:
+                msgType, payload = recvFrame(self.sock)
+                if msgType == ACCEPT:
+                    requestId, otherPeerId = decodeFields(payload, 2)
+                    result = otherPeerId
+                elif msgType == REJECT:
+                    requestId = decodeFields(payload, 1)[0]
+                    result = None
+                else:
+                    raise ProtocolError("Unexpected message " + str(msgType))
+                future = self.pending.pop(requestId, None)
+                if future is not None:
+                    future.set_result(result)
+        except (OSError, ProtocolError) as error:
+            self.fail(error)
+
+    def fail(self, error):
+        with self.sendLock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError(str(error)))
+
+    def close(self):
+        with self.sendLock:
+            if not self.closed:
+                try:
+                    sendFrame(self.sock, END)
+                except OSError:
+                    pass
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ConnectionPool:
+    # Keeps one authenticated PeerConnection per peer address
+
+    def __init__(self, myId, key):
+        self.myId = myId
+        self.key = key
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port):
+        with self.lock:
+            connection = self.connections.get((host, port))
+            if connection is None or connection.closed:
+                connection = PeerConnection(host, port, self.myId, self.key)
+                self.connections[(host, port)] = connection
+            return connection
+
+    def discard(self, host, port, connection):
+        # Drops a connection that failed, unless it was already replaced
+        with self.lock:
+            if self.connections.get((host, port)) is connection:
+                del self.connections[(host, port)]
+        connection.close()
+
+    def closeAll(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
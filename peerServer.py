@@ -0,0 +1,128 @@
+import asyncio
+import random
+import threading
+
+from chainFormat import ChainFormatError
+from gossip import GOSSIP_MESSAGES, GossipPeer
+from wireProtocol import (
+    ACCEPT, CHALLENGE, REJECT, REQUEST, RESPONSE, SEND,
+    ProtocolError, bytesToInt, decodeFields, encodeFields, intToBytes, readFrame, writeFrame
+)
+
+MAX_SESSIONS = 256          # Sessions served at once, later connections wait their turn
+SESSION_TIMEOUT = 30        # Seconds a peer may stay silent before it is dropped
+
+
+class PeerServer:
+    # Serves many authenticated payment sessions at once on one event loop.
+    # handler(typeOfReq, otherPeerId, amount, nonce) decides a request and returns
+    # True to accept, False to reject or None when the peer is unknown. It
+    # is run on a worker thread while holding lock, so chain updates (which
+    # may mine a block) never block the other sessions. With a Gossip, a
+    # session that sends gossip messages also receives block announcements.
+
+    def __init__(self, handler, myId, key, lock = None, gossip = None):
+        self.handler = handler
+        self.myId = myId
+        self.key = key
+        self.gossip = gossip
+        self.lock = lock or threading.Lock()
+        self.sessions = asyncio.Semaphore(MAX_SESSIONS)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def read(self, reader):
+        return await readFrame(reader, SESSION_TIMEOUT)
+
+    async def write(self, writer, msgType, payload = b""):
+        # writeFrame waits on drain(), so a peer that isn't reading can't make
+        # the server buffer without limit
+        await writeFrame(writer, msgType, payload, SESSION_TIMEOUT)
+
+    def decide(self, typeOfReq, otherPeerId, amount, nonce):
+        with self.lock:
+            return self.handler(typeOfReq, otherPeerId, amount, nonce)
+
+    async def handleConnection(self, reader, writer):
+        async with self.sessions:
+            addr = writer.get_extra_info("peername")
+            print('Connected by', addr, end="\n\n")
+            try:
+                await self.runSession(reader, writer)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ProtocolError, ChainFormatError):
+                print("Session with", addr, "dropped")
+            finally:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except ConnectionError:
+                    pass
+            print("Connection Terminated...")
+
+    async def runSession(self, reader, writer):
+        msgType, payload = await self.read(reader)
+        if msgType != CHALLENGE:
+            return
+        pt = self.key.decrypt(bytesToInt(payload))
+        await self.write(writer, RESPONSE, intToBytes(pt))
+
+        randNum = random.randint(1000000000, 9999999999)
+        ct = self.key.encrypt(randNum)
+        await self.write(writer, CHALLENGE, intToBytes(ct))
+
+        msgType, payload = await self.read(reader)
+        if msgType != RESPONSE:
+            return
+        if bytesToInt(payload) != randNum:
+            print("Unauthorized User")
+            print("...Disconnecting...")
+            return
+        print("User Authenticated\n")
+
+        # An authenticated session carries any number of requests, possibly
+        # pipelined, until the peer sends END or disconnects. Replies go
+        # through the GossipPeer so they don't interleave with announcements.
+        peer = GossipPeer(writer)
+        try:
+            await self.serveRequests(reader, peer)
+        finally:
+            if self.gossip is not None:
+                self.gossip.removePeer(peer)
+
+    async def serveRequests(self, reader, peer):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                msgType, payload = await self.read(reader)
+            except asyncio.IncompleteReadError as error:
+                if error.partial:
+                    raise
+                return
+
+            if msgType in GOSSIP_MESSAGES:
+                if self.gossip is not None:
+                    self.gossip.addPeer(peer)
+                    await self.gossip.handle(peer, msgType, payload)
+                continue
+
+            if msgType == SEND:
+                typeOfReq = b'send'
+            elif msgType == REQUEST:
+                typeOfReq = b'request'
+            else:
+                return
+            requestId, otherPeerId, amount, nonce = decodeFields(payload, 3, 1)
+            print("Request Type: ", typeOfReq.decode("utf-8"))
+            print("ID received: ", otherPeerId)
+            print("Amount: ", amount, end="\n\n")
+
+            accepted = await loop.run_in_executor(None, self.decide, typeOfReq, otherPeerId, amount, nonce)
+            if accepted:
+                print("Accepted\n")
+                await peer.send(ACCEPT, encodeFields(requestId, self.myId))
+            else:
+                print("Not matching node found" if accepted is None else "Rejected\n")
+                await peer.send(REJECT, encodeFields(requestId))
@@ -0,0 +1,34 @@
+import random
+import sys
+import time
+
+from rsaKeys import loadAuthKey
+
+# Compares plain and CRT decryption with the key in authKey.txt
+#
+#   python rsaBenchmark.py [rounds]
+
+
+def timeDecryption(decrypt, ciphertexts):
+    start = time.perf_counter()
+    for ct in ciphertexts:
+        decrypt(ct)
+    return (time.perf_counter() - start) / len(ciphertexts)
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    key = loadAuthKey()
+    if key.p is None:
+        print("authKey.txt has no p and q, run keyGen.py again to enable CRT decryption")
+        sys.exit(1)
+
+    ciphertexts = [key.encrypt(random.randint(1000000000, 9999999999)) for _ in range(rounds)]
+    for ct in ciphertexts[:10]:
+        assert key.decrypt(ct) == key.decryptWithoutCRT(ct)
+
+    plain = timeDecryption(key.decryptWithoutCRT, ciphertexts)
+    crt = timeDecryption(key.decrypt, ciphertexts)
+    print(f"pow(ct, d, N): {plain * 1e6:8.1f} us per decryption")
+    print(f"CRT:           {crt * 1e6:8.1f} us per decryption")
+    print(f"Speedup:       {plain / crt:8.2f}x")
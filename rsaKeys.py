@@ -0,0 +1,47 @@
+import functools
+
+
+class RSAKey:
+    # The shared authentication key. When p and q are known decryption uses
+    # the Chinese Remainder Theorem: two half size exponentiations mod p and
+    # mod q are about 3-4x faster than one full size one mod N.
+
+    def __init__(self, e, d, N, p = None, q = None):
+        self.e = e
+        self.d = d
+        self.N = N
+        self.p = p
+        self.q = q
+        if p is not None and q is not None:
+            self.dp = d % (p - 1)
+            self.dq = d % (q - 1)
+            self.qinv = pow(q, -1, p)
+
+    def encrypt(self, pt):
+        return pow(pt, self.e, self.N)
+
+    def decrypt(self, ct):
+        if self.p is None:
+            return pow(ct, self.d, self.N)
+        m1 = pow(ct, self.dp, self.p)
+        m2 = pow(ct, self.dq, self.q)
+        h = (self.qinv * (m1 - m2)) % self.p
+        return m2 + h * self.q
+
+    def decryptWithoutCRT(self, ct):
+        return pow(ct, self.d, self.N)
+
+
+def parseAuthKey(contents):
+    # "e;;d;;N", followed by ";;p;;q" in files written by the current keyGen.py
+    values = [int(value) for value in contents.split(";;")]
+    if len(values) == 5:
+        return RSAKey(*values)
+    return RSAKey(values[0], values[1], values[2])
+
+
+@functools.lru_cache(maxsize = None)
+def loadAuthKey(filename = "authKey.txt"):
+    # Read once per process, later calls return the same key object
+    with open(filename, 'r') as authKeyFile:
+        return parseAuthKey(authKeyFile.read())
@@ -0,0 +1,278 @@
+import collections
+import os
+import sqlite3
+
+import chainFormat
+from batchAdmission import checkTransactions
+from blockStore import BlockStore, blockChanges
+from mempool import transactionId
+from txIndex import HISTORY_PAGE_SIZE
+
+# Storage backends for Blockchain.loadFromStore and saveToStore. A backend
+# has load(blockchain, Block, Transaction, Node, lazy) filling an empty
+# Blockchain and save(blockchain) writing it:
+#   TextStorage     the ";;" delimited text file, rewritten on each save
+#   BinaryStorage   the single binary chain file, rewritten on each save
+#   BlockStore      the append-only block log directory
+#   SQLiteStorage   an SQLite database in WAL mode
+# openStorage picks the backend for a path.
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    height INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    prevHash TEXT NOT NULL,
+    timestamp REAL,
+    proofOfWorkNo INTEGER NOT NULL,
+    difficulty INTEGER,
+    merkleRoot TEXT
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    height INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    txId TEXT NOT NULL,
+    senderId INTEGER NOT NULL,
+    receiverId INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    nonce INTEGER,
+    PRIMARY KEY (height, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transactionsBySender ON transactions (senderId, height, position);
+CREATE INDEX IF NOT EXISTS transactionsByReceiver ON transactions (receiverId, height, position);
+CREATE INDEX IF NOT EXISTS transactionsById ON transactions (txId);
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER NOT NULL UNIQUE,
+    address TEXT NOT NULL,
+    balance INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    position INTEGER PRIMARY KEY,
+    senderId INTEGER NOT NULL,
+    receiverId INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    nonce INTEGER
+);
+"""
+
+
+def isSQLite(filename):
+    with open(filename, 'rb') as ipFile:
+        return ipFile.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def openStorage(filename):
+    if os.path.isdir(filename):
+        return BlockStore(filename)
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        if isSQLite(filename):
+            return SQLiteStorage(filename)
+        if chainFormat.isBinaryChain(filename):
+            return BinaryStorage(filename)
+        return TextStorage(filename)
+    if filename.endswith(SQLITE_EXTENSIONS):
+        return SQLiteStorage(filename)
+    if filename.endswith(".bin"):
+        return BinaryStorage(filename)
+    return TextStorage(filename)
+
+
+class TextStorage:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self, blockchain, Block, Transaction, Node, lazy = False):
+        blockchain.loadBlockchain(self.filename)
+
+    def save(self, blockchain):
+        blockchain.saveBlockchain(self.filename)
+
+
+class BinaryStorage:
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self, blockchain, Block, Transaction, Node, lazy = False):
+        if lazy:
+            blockchain.loadBlockchainLazy(self.filename)
+        else:
+            blockchain.loadBlockchainBinary(self.filename)
+
+    def save(self, blockchain):
+        blockchain.saveBlockchainBinary(self.filename)
+
+
+class SQLiteStorage:
+    # The accounts table holds the balances the stored blocks give, without
+    # the pending transactions, and is updated in the same database
+    # transaction as each block, so a crash never leaves the two out of
+    # step. Pending transactions are checked again against those balances
+    # when the chain is loaded. Other processes can read the database while
+    # a node writes to it.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    @property
+    def blockCount(self):
+        (height,) = self.connection.execute("SELECT MAX(height) FROM blocks").fetchone()
+        return 0 if height is None else height + 1
+
+    def storedHash(self, height):
+        row = self.connection.execute("SELECT hash FROM blocks WHERE height = ?", (height,)).fetchone()
+        return None if row is None else row[0]
+
+    def storedChanges(self, fromHeight):
+        # Net balance change per account of the stored blocks from fromHeight on
+        changes = collections.Counter()
+        rows = self.connection.execute(
+            "SELECT senderId, receiverId, amount FROM transactions WHERE height >= ? AND senderId != 0", (fromHeight,)
+        )
+        for senderId, receiverId, amount in rows:
+            changes[senderId] -= amount
+            changes[receiverId] += amount
+        return changes
+
+    def applyChanges(self, changes, sign):
+        self.connection.executemany(
+            "UPDATE accounts SET balance = balance + ? WHERE id = ?",
+            [(sign * change, accountId) for accountId, change in changes.items() if change]
+        )
+
+    def rewind(self, blockchain):
+        # Removes stored blocks that a reorganization took off the chain
+        storedCount = self.blockCount
+        count = min(storedCount, len(blockchain.chain))
+        while count > 0 and self.storedHash(count - 1) != blockchain.chain[count - 1].calculateHash():
+            count -= 1
+        if count == storedCount:
+            return count
+        with self.connection:
+            self.applyChanges(self.storedChanges(count), -1)
+            self.connection.execute("DELETE FROM transactions WHERE height >= ?", (count,))
+            self.connection.execute("DELETE FROM blocks WHERE height >= ?", (count,))
+        return count
+
+    def addAccounts(self, blockchain, newBlocks):
+        # Accounts registered since the last save, with their balances
+        # before the blocks that aren't stored yet
+        known = {accountId for (accountId,) in self.connection.execute("SELECT id FROM accounts")}
+        nodes = [node for node in blockchain.nodes if int(node.id) not in known]
+        if not nodes:
+            return
+        confirmed = blockchain.confirmedNodes()
+        changes = blockChanges(newBlocks, blockchain.balanceChanges)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO accounts (id, address, balance) VALUES (?, ?, ?)",
+                [(int(node.id), str(node.address), confirmed[node.id].balance - changes[node.id]) for node in nodes]
+            )
+
+    def insertBlock(self, block, balanceChanges):
+        transactions = block.uncommittedTransactions
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO blocks (height, hash, prevHash, timestamp, proofOfWorkNo, difficulty, merkleRoot) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (block.index, block.calculateHash(), str(block.prevHash), block.timestamp, block.proofOfWorkNo, block.difficulty, block.merkleRoot)
+            )
+            self.connection.executemany(
+                "INSERT INTO transactions (height, position, txId, senderId, receiverId, amount, nonce) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (block.index, position, transactionId(transaction), int(transaction.senderId), int(transaction.receiverId), int(transaction.amount), transaction.nonce)
+                    for position, transaction in enumerate(transactions)
+                ]
+            )
+            self.applyChanges(balanceChanges(transactions), 1)
+
+    def save(self, blockchain):
+        # Each new block is one database transaction. Saving ends with a
+        # synchronous commit, which in WAL mode makes the blocks committed
+        # before it durable too.
+        chain = blockchain.chain
+        count = self.rewind(blockchain)
+        newBlocks = [chain[i] for i in range(count, len(chain))]
+        self.addAccounts(blockchain, newBlocks)
+        for block in newBlocks:
+            self.insertBlock(block, blockchain.balanceChanges)
+
+        self.connection.execute("PRAGMA synchronous = FULL")
+        try:
+            with self.connection:
+                self.connection.execute("DELETE FROM pending")
+                self.connection.executemany(
+                    "INSERT INTO pending (position, senderId, receiverId, amount, nonce) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (position, int(transaction.senderId), int(transaction.receiverId), int(transaction.amount), transaction.nonce)
+                        for position, transaction in enumerate(blockchain.uncommittedTransactions)
+                    ]
+                )
+        finally:
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+
+    def load(self, blockchain, Block, Transaction, Node, lazy = False):
+        # lazy isn't supported, the whole chain is read
+        for accountId, address, balance in self.connection.execute("SELECT id, address, balance FROM accounts ORDER BY rowid"):
+            blockchain.registerNode(Node(nodeId = accountId, address = address, balance = balance))
+
+        transactions = self.connection.execute(
+            "SELECT height, senderId, receiverId, amount, nonce FROM transactions ORDER BY height, position"
+        )
+        nextTransaction = next(transactions, None)
+        blocks = self.connection.execute(
+            "SELECT height, hash, prevHash, timestamp, proofOfWorkNo, difficulty, merkleRoot FROM blocks ORDER BY height"
+        )
+        for height, blockHash, prevHash, timestamp, proofOfWorkNo, difficulty, merkleRoot in blocks:
+            blockTransactions = []
+            while nextTransaction is not None and nextTransaction[0] == height:
+                _, senderId, receiverId, amount, nonce = nextTransaction
+                blockTransactions.append(Transaction(senderId, receiverId, amount, nonce))
+                nextTransaction = next(transactions, None)
+            block = Block(
+                index = height,
+                proofOfWorkNo = proofOfWorkNo,
+                prevHash = prevHash,
+                uncommittedTransactions = blockTransactions,
+                timestamp = timestamp,
+                difficulty = difficulty,
+                merkleRoot = merkleRoot
+            )
+            # As with the binary formats the stored hash is trusted
+            block.blockHash = blockHash
+            blockchain.appendBlock(block)
+
+        pending = [
+            Transaction(senderId, receiverId, amount, nonce)
+            for senderId, receiverId, amount, nonce in self.connection.execute(
+                "SELECT senderId, receiverId, amount, nonce FROM pending ORDER BY position"
+            )
+        ]
+        accepted, _ = checkTransactions(blockchain.nodesById, pending)
+        blockchain.applyBalanceChanges(blockchain.balanceChanges(accepted), 1)
+        blockchain.loadMempool(accepted)
+
+    def accountHistory(self, accountId, start = 0, count = HISTORY_PAGE_SIZE):
+        # A page of (height, position, senderId, receiverId, amount, nonce)
+        # rows of the stored transactions accountId sent or received, newest first
+        return self.connection.execute(
+            "SELECT height, position, senderId, receiverId, amount, nonce FROM transactions WHERE senderId = ?1 AND senderId != 0 "
+            "UNION ALL SELECT height, position, senderId, receiverId, amount, nonce FROM transactions WHERE receiverId = ?1 "
+            "ORDER BY height DESC, position DESC LIMIT ?2 OFFSET ?3",
+            (accountId, count, start)
+        ).fetchall()
+
+    def transactionLocations(self, txId):
+        # (height, position) of the stored transactions with this transactionId
+        return self.connection.execute(
+            "SELECT height, position FROM transactions WHERE txId = ? ORDER BY height, position", (txId,)
+        ).fetchall()
@@ -0,0 +1,76 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from merkle import merkleRoot
+from peer import Block, Blockchain, Transaction
+
+# Round trips blockchain.txt, whose blocks predate difficulties and Merkle
+# roots, with new blocks mined on top of it
+#
+#   python -m unittest test_blockchainText
+
+LEGACY_CHAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blockchain.txt")
+
+
+class BlockchainTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "blockchain.txt")
+        shutil.copy(LEGACY_CHAIN, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return Blockchain(self.filename, miningWorkers = 1)
+
+    def testRoundTripWithNewBlocks(self):
+        blockchain = self.load()
+        legacyLength = len(blockchain.chain)
+        self.assertIsNone(blockchain.chain[-1].merkleRoot)
+        with contextlib.redirect_stdout(io.StringIO()):
+            blockchain.mineNewBlock(myId = 93)
+            blockchain.addNewTransaction(Transaction(93, 14, 5, 1))
+            blockchain.mineNewBlock(myId = 93)
+        blockchain.saveBlockchain(self.filename)
+
+        reloaded = self.load()
+        self.assertEqual(len(reloaded.chain), legacyLength + 2)
+        self.assertEqual(
+            [block.calculateHash() for block in reloaded.chain],
+            [block.calculateHash() for block in blockchain.chain]
+        )
+        self.assertIsNotNone(reloaded.chain[-1].merkleRoot)
+        self.assertIsNone(reloaded.validateChain())
+        self.assertEqual(
+            [node.toString() for node in reloaded.nodes],
+            [node.toString() for node in blockchain.nodes]
+        )
+
+    def testMerkleRootNeedsDifficulty(self):
+        blockchain = self.load()
+        tip = blockchain.chain[-1]
+        transactions = [Transaction("0", 93, 1)]
+        block = Block(
+            index = tip.index + 1,
+            proofOfWorkNo = 0,
+            prevHash = tip.calculateHash(),
+            uncommittedTransactions = transactions,
+            timestamp = tip.timestamp + 1,
+            difficulty = None,
+            merkleRoot = merkleRoot(transactions)
+        )
+        self.assertEqual(blockchain.checkBlock(block, tip), 7)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(blockchain.receiveBlock(block))
+        self.assertEqual(len(blockchain.chain), tip.index + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import array
+import hashlib
+
+# Secondary indexes over the transactions on the chain:
+#   byAccount   account id -> locations of the transactions it sent or
+#               received, in chain order
+#   byId        first 8 bytes of the transactionId -> location, or a list
+#               of locations when more than one transaction has them
+# A location packs (block index, position in the block) into one int and
+# the postings are arrays of them. byId keeps only part of the ID, so the
+# transactions at its locations are candidates the caller has to check.
+# The mining reward's "0" sender isn't indexed.
+
+POSITION_BITS = 32
+HISTORY_PAGE_SIZE = 50      # Transactions per account history page
+
+
+def transactionKey(transaction):
+    return int.from_bytes(hashlib.sha256(transaction.toString().encode()).digest()[:8], "little")
+
+
+def idKey(txId):
+    return int.from_bytes(bytes.fromhex(txId)[:8], "little")
+
+
+def packLocation(blockIndex, position):
+    return blockIndex << POSITION_BITS | position
+
+
+def unpackLocation(location):
+    return location >> POSITION_BITS, location & ((1 << POSITION_BITS) - 1)
+
+
+class TransactionIndex:
+    # The first query indexes the whole chain with catchUp, so loading a
+    # chain doesn't pay for an index nobody reads. From then on blocks are
+    # indexed in chain order and removed from the tip as appendBlock and
+    # disconnectBlock change the chain.
+
+    def __init__(self):
+        self.byAccount = {}
+        self.byId = {}
+        self.blockCount = 0     # Blocks of the chain indexed
+        self.active = False
+
+    def accounts(self, transaction):
+        if str(transaction.senderId) == "0":
+            return (transaction.receiverId,)
+        return (transaction.senderId, transaction.receiverId)
+
+    def addBlock(self, block):
+        # Ignores blocks that aren't next in line, catchUp indexes them later
+        if not self.active or block.index != self.blockCount:
+            return
+        for position, transaction in enumerate(block.uncommittedTransactions):
+            location = packLocation(block.index, position)
+            for accountId in self.accounts(transaction):
+                postings = self.byAccount.get(accountId)
+                if postings is None:
+                    postings = self.byAccount[accountId] = array.array("q")
+                postings.append(location)
+
+            key = transactionKey(transaction)
+            existing = self.byId.get(key)
+            if existing is None:
+                self.byId[key] = location
+            elif isinstance(existing, list):
+                existing.append(location)
+            else:
+                self.byId[key] = [existing, location]
+        self.blockCount += 1
+
+    def removeBlock(self, block):
+        # Only the last indexed block can be removed
+        if block.index != self.blockCount - 1:
+            return
+        for position, transaction in reversed(list(enumerate(block.uncommittedTransactions))):
+            for accountId in self.accounts(transaction):
+                postings = self.byAccount[accountId]
+                postings.pop()
+                if not postings:
+                    del self.byAccount[accountId]
+
+            key = transactionKey(transaction)
+            existing = self.byId[key]
+            if isinstance(existing, list):
+                existing.pop()
+                if len(existing) == 1:
+                    self.byId[key] = existing[0]
+            else:
+                del self.byId[key]
+        self.blockCount -= 1
+
+    def catchUp(self, chain):
+        self.active = True
+        for index in range(self.blockCount, len(chain)):
+            self.addBlock(chain[index])
+
+    def accountLocations(self, accountId, start = 0, count = HISTORY_PAGE_SIZE):
+        # Locations of the account's transactions, newest first, skipping
+        # the start newest
+        postings = self.byAccount.get(accountId)
+        if postings is None or start >= len(postings):
+            return []
+        end = len(postings) - start
+        return [unpackLocation(location) for location in reversed(postings[max(end - count, 0):end])]
+
+    def accountTransactionCount(self, accountId):
+        postings = self.byAccount.get(accountId)
+        return 0 if postings is None else len(postings)
+
+    def locate(self, txId):
+        # Candidate locations of the transaction with this transactionId, newest first
+        try:
+            key = idKey(txId)
+        except ValueError:
+            return []
+        locations = self.byId.get(key)
+        if locations is None:
+            return []
+        if not isinstance(locations, list):
+            locations = [locations]
+        return [unpackLocation(location) for location in reversed(locations)]
@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import sys
+import time
+
+import chainFormat
+from blockStore import BlockStore
+from lazyChain import mapFile, scanBlockOffsets
+from peer import BLOCK_ERRORS, Block, Blockchain, Transaction
+
+# Checks the index, hash link, difficulty, timestamp and proof of work of
+# every block of a chain file, a binary chain file or a block store. The
+# blocks are split into chunks that are checked in a process pool, each
+# worker reading its own chunk straight from the file.
+#
+#   python validateChain.py blockchain.txt [workers]
+
+CHUNK_SIZE = 2000       # Blocks per job
+
+
+def readSource(filename):
+    # Returns (kind, filename to read blocks from, one item per block)
+    if os.path.isdir(filename):
+        store = BlockStore(filename)
+        return "binary", store.logFilename, store.offsets
+    if chainFormat.isBinaryChain(filename):
+        data = mapFile(filename)
+        try:
+            offsets, _ = scanBlockOffsets(data)
+        finally:
+            data.close()
+        return "binary", filename, offsets
+
+    with open(filename, 'r') as ipFile:
+        blockchainString = ipFile.read().split(";;;;")[0]
+    return "text", filename, blockchainString.split(";;;")
+
+
+def checker():
+    return Blockchain(miningWorkers = 1)
+
+
+def decodeBlocks(kind, filename, items):
+    if kind == "text":
+        blockchain = checker()
+        return [blockchain.blockFromString(item) for item in items]
+
+    data = mapFile(filename)
+    try:
+        return [chainFormat.decodeBlock(data, start, Block, Transaction)[0] for start, _ in items]
+    finally:
+        data.close()
+
+
+def validateChunk(job):
+    # items holds the chunk's blocks after context blocks it is checked against
+    kind, filename, items, context = job
+    blocks = decodeBlocks(kind, filename, items)
+    if context == 0 and blocks[0].index != 0:
+        return blocks[0].index, 1
+    return checker().validateChain(blocks, max(context, 1))
+
+
+def makeJobs(kind, filename, items, retargetInterval):
+    # Each chunk carries the blocks before it that its checks look back to,
+    # the parent of its first block and the start of a retarget interval
+    for start in range(0, len(items), CHUNK_SIZE):
+        context = min(start, retargetInterval)
+        yield kind, filename, items[start - context:start + CHUNK_SIZE], context
+
+
+def firstError(results):
+    for result in results:
+        if result is not None:
+            return result
+    return None
+
+
+def validateChain(filename, workers = None):
+    # Returns (index, error code) of the first bad block or None, and the block count
+    kind, filename, items = readSource(filename)
+    if not items:
+        return None, 0
+    jobs = makeJobs(kind, filename, items, checker().retargetInterval)
+
+    if workers == 1:
+        return firstError(map(validateChunk, jobs)), len(items)
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the chunk order, so the first error found is the first
+        # bad block. Leaving the pool terminates the remaining jobs.
+        return firstError(pool.imap(validateChunk, jobs)), len(items)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python validateChain.py <chain file or store> [workers]")
+        sys.exit(1)
+
+    workers = int(sys.argv[2]) if len(sys.argv) == 3 else None
+    startTime = time.time()
+    error, blockCount = validateChain(sys.argv[1], workers)
+    elapsed = time.time() - startTime
+
+    if error is None:
+        print("Valid chain of", blockCount, "blocks, checked in", round(elapsed, 2), "seconds")
+    else:
+        index, code = error
+        print("Block", index, "is invalid:", BLOCK_ERRORS[code])
+        sys.exit(1)
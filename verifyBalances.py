@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+
+import chainFormat
+from blockStore import BlockStore, readState
+from lazyChain import mapFile
+from peer import Block, Blockchain, Node, Transaction
+
+# Rebuilds the balances of a block store from its first snapshot, taken at
+# the genesis block, by replaying every block after it, and checks them
+# against each later snapshot and the checkpoint. A node missing from the
+# first snapshot was registered later, it is checked from the first
+# snapshot that lists it. A store saved before the genesis snapshot was kept
+# gets one on its next save, until then only the blocks after its first
+# snapshot are checked.
+#
+#   python verifyBalances.py <store>
+
+
+def verifyBalances(directory):
+    # Returns a list of (block count, node id, expected, stored) mismatches
+    # and the number of blocks replayed
+    store = BlockStore(directory)
+    heights = store.snapshotHeights()
+    if not heights:
+        raise ValueError("No balance snapshots in " + directory)
+    states = [store.readSnapshot(height, Transaction, Node) for height in heights]
+    if os.path.exists(store.checkpointFilename):
+        checkpoint = readState(store.checkpointFilename, Transaction, Node)
+        if checkpoint[1] is not None:
+            states.append(checkpoint)
+    states.sort(key = lambda state: state[0])
+
+    balances = {}
+    known = set()
+    mismatches = []
+    data = mapFile(store.logFilename)
+    try:
+        blockCount = states[0][0]
+        for stateBlockCount, tipHash, _, nodes in states:
+            if stateBlockCount > store.blockCount or store.storedHash(stateBlockCount - 1) != tipHash:
+                raise ValueError("State of block " + str(stateBlockCount - 1) + " isn't on the block log")
+            for index in range(blockCount, stateBlockCount):
+                block, _ = chainFormat.decodeBlock(data, store.offsets[index][0], Block, Transaction)
+                for nodeId, change in Blockchain.balanceChanges(block.uncommittedTransactions).items():
+                    balances[nodeId] = balances.get(nodeId, 0) + change
+            blockCount = stateBlockCount
+
+            for node in nodes:
+                if node.id not in known:
+                    known.add(node.id)
+                    balances[node.id] = node.balance
+                elif balances[node.id] != node.balance:
+                    mismatches.append((stateBlockCount, node.id, balances[node.id], node.balance))
+    finally:
+        data.close()
+    return mismatches, blockCount - states[0][0]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python verifyBalances.py <store>")
+        sys.exit(1)
+
+    startTime = time.time()
+    mismatches, replayed = verifyBalances(sys.argv[1])
+    elapsed = time.time() - startTime
+
+    firstHeight = BlockStore(sys.argv[1]).snapshotHeights()[0]
+    if firstHeight != 1:
+        print("The first snapshot is at block", firstHeight - 1, "so earlier blocks weren't checked, save the store to add one at the genesis block")
+
+    for blockCount, nodeId, expected, stored in mismatches:
+        print("Block", blockCount - 1, "node", nodeId, "should have", expected, "but has", stored)
+    if mismatches:
+        sys.exit(1)
+    print("Balances match after replaying", replayed, "blocks, checked in", round(elapsed, 2), "seconds")
@@ -0,0 +1,143 @@
+import asyncio
+
+# Every message is one frame: a type tag byte, a varint payload length and
+# the payload. Integers inside payloads are unsigned varints (7 bits per
+# byte, low bits first); RSA values are sent as the whole payload in
+# minimal big endian bytes. Frames are read with exact sizes, so it doesn't
+# matter how TCP splits or joins segments.
+
+CHALLENGE = 1       # RSA encrypted random number
+RESPONSE = 2        # Decrypted challenge
+END = 3             # Peer gives up on or ends the session
+SEND = 4            # requestId, myId, amount, optional transaction nonce
+REQUEST = 5         # requestId, myId, amount, optional transaction nonce
+ACCEPT = 6          # requestId, myId
+REJECT = 7          # requestId
+INV = 8             # 32 byte block hashes
+GETDATA = 9         # 32 byte block hashes
+BLOCK = 10          # chainFormat.encodeBlock record
+GETHEADERS = 11     # start index, count
+HEADERS = 12        # chainFormat.encodeHeader records
+
+MAX_FRAME_SIZE = 1 << 20
+MAX_LENGTH_BYTES = (MAX_FRAME_SIZE.bit_length() + 6) // 7    # Varint bytes a frame length may take
+MAX_VARINT_BYTES = 10       # Enough for any 64 bit field
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encodeVarint(value):
+    if value < 0:
+        raise ProtocolError("Varints can't be negative")
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def decodeVarint(data, offset = 0):
+    value = 0
+    shift = 0
+    for _ in range(MAX_VARINT_BYTES):
+        if offset >= len(data):
+            raise ProtocolError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+    raise ProtocolError("Varint too long")
+
+
+def encodeFields(*values):
+    return b"".join(encodeVarint(value) for value in values)
+
+
+def decodeFields(payload, count, optional = 0):
+    # Up to optional more fields are read if present, missing ones are None
+    values = []
+    offset = 0
+    for _ in range(count):
+        value, offset = decodeVarint(payload, offset)
+        values.append(value)
+    for _ in range(optional):
+        value = None
+        if offset < len(payload):
+            value, offset = decodeVarint(payload, offset)
+        values.append(value)
+    return values
+
+
+def intToBytes(value):
+    return value.to_bytes((value.bit_length() + 7) // 8, "big")
+
+
+def bytesToInt(payload):
+    return int.from_bytes(payload, "big")
+
+
+def encodeFrame(msgType, payload = b""):
+    return bytes((msgType,)) + encodeVarint(len(payload)) + payload
+
+
+def recvExactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed mid frame")
+        data += chunk
+    return bytes(data)
+
+
+def sendFrame(sock, msgType, payload = b""):
+    sock.sendall(encodeFrame(msgType, payload))
+
+
+def recvFrame(sock):
+    msgType = recvExactly(sock, 1)[0]
+    length = 0
+    shift = 0
+    # The length is read a byte at a time, so it is cut off before it can
+    # grow past what MAX_FRAME_SIZE needs
+    for _ in range(MAX_LENGTH_BYTES):
+        byte = recvExactly(sock, 1)[0]
+        length |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    else:
+        raise ProtocolError("Frame length too long")
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError("Frame too large")
+    return msgType, recvExactly(sock, length)
+
+
+async def readFrame(reader, timeout = None):
+    msgType = (await asyncio.wait_for(reader.readexactly(1), timeout))[0]
+    length = 0
+    shift = 0
+    for _ in range(MAX_LENGTH_BYTES):
+        byte = (await asyncio.wait_for(reader.readexactly(1), timeout))[0]
+        length |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    else:
+        raise ProtocolError("Frame length too long")
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError("Frame too large")
+    return msgType, await asyncio.wait_for(reader.readexactly(length), timeout)
+
+
+async def writeFrame(writer, msgType, payload = b"", timeout = None):
+    writer.write(encodeFrame(msgType, payload))
+    await asyncio.wait_for(writer.drain(), timeout)